@@ -0,0 +1,75 @@
+"""compares the train steps / sec of the tf.function step with the xla compiled one
+(jit_compile) on cpu, for batches of random lengths trimmed to their longest example
+(current token batching) and bucketed to a few lengths (token batching with jit_compile).
+python3 -m benchmarks.jit_step"""
+import random
+import time
+
+import tensorflow as tf
+from absl import app as absl_app
+
+from transformer.transformer import Transformer
+from transformer.steps import build_model, get_train_step_fn
+from transformer.jit import TracedFunction, supports_function_compile, get_bucket_length
+
+tf.compat.v1.flags.DEFINE_integer('steps', default=100, help='timed train steps')
+tf.compat.v1.flags.DEFINE_integer('batch_size', default=16, help='')
+tf.compat.v1.flags.DEFINE_integer('seq_length', default=128, help='')
+tf.compat.v1.flags.DEFINE_integer('bucket', default=32, help='length bucket of the bucketed batches')
+tf.compat.v1.flags.DEFINE_integer('num_layers', default=2, help='')
+tf.compat.v1.flags.DEFINE_integer('d_model', default=128, help='')
+tf.compat.v1.flags.DEFINE_integer('dff', default=256, help='')
+tf.compat.v1.flags.DEFINE_integer('num_heads', default=4, help='')
+tf.compat.v1.flags.DEFINE_integer('dict_size', default=2048, help='')
+
+args = tf.compat.v1.flags.FLAGS
+
+step_signature = [tf.TensorSpec(shape=(None, 2, None), dtype=tf.int64),
+                  tf.TensorSpec(shape=(None, None), dtype=tf.int64)]
+
+
+def random_batches(nr_batches, bucketed):
+    batches = []
+    for _ in range(nr_batches):
+        length = random.randint(8, args.seq_length)
+        if bucketed:
+            length = min(get_bucket_length(length, args.bucket), args.seq_length)
+        batches.append(tf.random.uniform((args.batch_size, 2, length), minval=1,
+                                         maxval=args.dict_size, dtype=tf.int64))
+    return batches
+
+def get_train_step(jit_compile):
+    """the train step of transformer/steps.py on a new model"""
+    transformer = Transformer(args.num_layers, args.d_model, args.num_heads, args.dff,
+                              args.dict_size, args.dict_size, args.seq_length, args.seq_length)
+    build_model(transformer)
+    optimizer = tf.keras.optimizers.Adam(1e-4)
+    name = 'jit_train_step' if jit_compile else 'train_step'
+    return TracedFunction(get_train_step_fn(transformer, optimizer), name, step_signature, jit_compile=jit_compile)
+
+def steps_per_sec(train_step, batches):
+    start = time.time()
+    for data in batches:
+        # unpacked rows, the segments are not read
+        loss, _ = train_step(data, tf.zeros_like(data[:, 0]))
+        loss.numpy()
+    return len(batches) / (time.time() - start)
+
+def main(argv):
+    del argv
+    random.seed(0)
+    if not supports_function_compile():
+        tf.compat.v1.logging.warning('tf.function can not be compiled in this tf version, '
+                                     'the jit_compile runs are not compiled')
+    for bucketed in (False, True):
+        batches = random_batches(args.steps, bucketed)
+        for jit_compile in (False, True):
+            train_step = get_train_step(jit_compile)
+            # compilations included, they are part of the cost of unbucketed shapes
+            speed = steps_per_sec(train_step, batches)
+            tf.compat.v1.logging.info('bucketed {} jit_compile {}: {:.2f} steps/sec, {} shapes'.format(
+                bucketed, jit_compile, speed, len(train_step.shapes)))
+
+if __name__ == "__main__":
+    tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.INFO)
+    absl_app.run(main)
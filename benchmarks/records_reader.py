@@ -0,0 +1,93 @@
+"""compares the examples / sec of the single file tf records reader (serialized tensors,
+one parse per example) with the sharded int64 reader (batched parse_example).
+runs offline on synthetic records: python3 -m benchmarks.records_reader"""
+import os
+import random
+import tempfile
+import time
+
+import tensorflow as tf
+from absl import app as absl_app
+
+from transformer.serialization import serialize_example_ids, serialize_example_int64, get_shard_name,\
+    write_manifest, get_ids_dataset_tf_records
+
+tf.compat.v1.flags.DEFINE_integer('examples', default=20000, help='nr of synthetic examples')
+tf.compat.v1.flags.DEFINE_integer('seq_length', default=512, help='')
+tf.compat.v1.flags.DEFINE_integer('dict_size', default=(2**15), help='')
+tf.compat.v1.flags.DEFINE_integer('record_shards', default=8, help='')
+tf.compat.v1.flags.DEFINE_string('tf_records', default='', help='where to write the records, temp dir if empty')
+tf.compat.v1.flags.DEFINE_bool('pack', default=False, help='')
+tf.compat.v1.flags.DEFINE_integer('shuffle_seed', default=None, help='')
+tf.compat.v1.flags.DEFINE_bool('use_tpu', default=False, help='')
+tf.compat.v1.flags.DEFINE_string('bucket', default='', help='')
+
+args = tf.compat.v1.flags.FLAGS
+
+
+def synthetic_rows(nr_rows):
+    for _ in range(nr_rows):
+        length = random.randint(5, args.seq_length // 4)
+        source = [random.randint(1, args.dict_size) for _ in range(length)]
+        target = [random.randint(1, args.dict_size) for _ in range(length)]
+        segs = [0] * length + [1] * (args.seq_length - length)
+        padding = [0] * (args.seq_length - length)
+        yield source + padding, target + padding, segs
+
+def write_single_file(path, rows):
+    with tf.io.TFRecordWriter(path) as writer:
+        for source, target, segs in rows:
+            sentences = tf.constant([source, target], dtype=tf.int64)
+            writer.write(serialize_example_ids(sentences, tf.constant(segs, dtype=tf.int64)))
+
+def write_shards(path, split, rows):
+    counts = [0] * args.record_shards
+    writers = [tf.io.TFRecordWriter(os.path.join(path, get_shard_name(split, shard, args.record_shards)))
+                for shard in range(args.record_shards)]
+    for i, (source, target, segs) in enumerate(rows):
+        writers[i % args.record_shards].write(serialize_example_int64(source, target, segs))
+        counts[i % args.record_shards] += 1
+    for writer in writers:
+        writer.close()
+    return {'files': [get_shard_name(split, shard, args.record_shards) for shard in range(args.record_shards)],
+            'counts': counts, 'total': sum(counts)}
+
+def examples_per_sec(dataset):
+    start = time.time()
+    count = 0
+    for _ in dataset:
+        count += 1
+    return count / (time.time() - start)
+
+def main(argv):
+    del argv
+    path = args.tf_records or tempfile.mkdtemp()
+    single_path = os.path.join(path, 'single')
+    sharded_path = os.path.join(path, 'sharded')
+    os.makedirs(single_path, exist_ok=True)
+    os.makedirs(sharded_path, exist_ok=True)
+
+    rows = list(synthetic_rows(args.examples))
+    write_single_file(os.path.join(single_path, 'train.tfrecord'), rows)
+    write_single_file(os.path.join(single_path, 'dev.tfrecord'), rows[:1])
+    manifest = {'format': 'int64', 'seq_length': args.seq_length, 'pack': args.pack, 'bert': False,
+                'splits': {'train': write_shards(sharded_path, 'train', rows),
+                           'dev': write_shards(sharded_path, 'dev', rows[:1])}}
+    write_manifest(sharded_path, manifest)
+
+    args.tf_records = single_path
+    single_dataset, _ = get_ids_dataset_tf_records(args)
+    args.tf_records = sharded_path
+    sharded_dataset, _ = get_ids_dataset_tf_records(args)
+
+    # warm up the file cache before timing
+    examples_per_sec(tf.data.TFRecordDataset(os.path.join(single_path, 'train.tfrecord')))
+    single = examples_per_sec(single_dataset)
+    sharded = examples_per_sec(sharded_dataset)
+    tf.compat.v1.logging.info('single file reader: {:.1f} examples/sec'.format(single))
+    tf.compat.v1.logging.info('sharded batched reader: {:.1f} examples/sec ({:.2f}x)'.format(
+        sharded, sharded / single))
+
+if __name__ == "__main__":
+    tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.INFO)
+    absl_app.run(main)
@@ -0,0 +1,232 @@
+"""end to end benchmarks of the gec transformer on synthetic data, with randomly initialized
+models of the d_model presets (transformer/presets.py): startup time, input pipeline
+throughput (token store + batching), train step time, decode latency per sentence for
+several beam widths and memory peak, train step time and memory peak with and without
+--recompute_grad. the results are written as json, to compare runs:
+python3 -m benchmarks.suite --presets=64,128 --output=benchmark.json"""
+import time
+IMPORT_START = time.time()
+
+import argparse
+import json
+import platform
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+from absl import app as absl_app
+
+from transformer.dataset import prepare_datasets
+from transformer.jit import TracedFunction
+from transformer.presets import get_model_config
+from transformer.profiling import percentile
+from transformer.steps import build_model, get_train_step_fn, get_decode_step_fn, beam_decode
+from transformer.token_store import TokenStore, write_token_store
+from transformer.transformer import Transformer
+
+IMPORT_END = time.time()
+
+tf.compat.v1.flags.DEFINE_string('presets', default='64,128', help='d_model of the benchmarked presets')
+tf.compat.v1.flags.DEFINE_string('beams', default='1,4,8', help='beam widths of the decode benchmark')
+tf.compat.v1.flags.DEFINE_integer('batch_size', default=16, help='')
+tf.compat.v1.flags.DEFINE_integer('max_tokens', default=2048, help='token budget of the token batching benchmark')
+tf.compat.v1.flags.DEFINE_integer('buffer_size', default=128, help='shuffle buffer of the input pipeline')
+tf.compat.v1.flags.DEFINE_integer('examples', default=20000, help='synthetic examples of the input pipeline')
+tf.compat.v1.flags.DEFINE_integer('warmup_steps', default=3, help='untimed train steps (tracing)')
+tf.compat.v1.flags.DEFINE_integer('steps', default=20, help='timed train steps')
+tf.compat.v1.flags.DEFINE_integer('sentences', default=5, help='decoded sentences for each beam width')
+tf.compat.v1.flags.DEFINE_integer('decode_length', default=32, help='decoding steps of each sentence')
+tf.compat.v1.flags.DEFINE_integer('seed', default=0, help='')
+tf.compat.v1.flags.DEFINE_string('output', default='benchmark.json', help='json file of the results')
+tf.compat.v1.flags.DEFINE_bool('recompute', default=True,
+                               help='train step time and memory peak with and without --recompute_grad, '
+                                    'each in its own process')
+tf.compat.v1.flags.DEFINE_bool('recompute_grad', default=False, help='recompute the layers of the train step')
+tf.compat.v1.flags.DEFINE_bool('train_only', default=False,
+                               help='only the train benchmark (the processes of the recompute cases)')
+
+args = tf.compat.v1.flags.FLAGS
+
+# the train step of transformer.py without packing: data and (unused) segments
+step_signature = [tf.TensorSpec(shape=(None, 2, None), dtype=tf.int64),
+                  tf.TensorSpec(shape=(None, None), dtype=tf.int64)]
+
+
+def get_memory_peak_mb():
+    """max resident memory of the process so far (ru_maxrss is in KB on linux)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def get_latency_stats(durations):
+    values = sorted(durations)
+    stats = {'mean_ms': 1000 * sum(values) / len(values)}
+    for q in (50, 90, 99):
+        stats['p{}_ms'.format(q)] = 1000 * percentile(values, q)
+    return stats
+
+def synthetic_examples(nr_examples, config):
+    """unpadded (source, target) pairs of random lengths up to a quarter of seq_length"""
+    for _ in range(nr_examples):
+        length = random.randint(5, max(5, config['seq_length'] // 4))
+        yield ([random.randint(1, config['dict_size']) for _ in range(length)],
+               [random.randint(1, config['dict_size']) for _ in range(length)])
+
+def synthetic_batch(config, batch_size):
+    """padded (batch_size, 2, seq_length) ids"""
+    data = np.zeros((batch_size, 2, config['seq_length']), dtype=np.int64)
+    for b, (source, target) in enumerate(synthetic_examples(batch_size, config)):
+        data[b, 0, :len(source)] = source
+        data[b, 1, :len(target)] = target
+    return tf.constant(data)
+
+def get_model(config, recompute=False):
+    vocab_size = config['dict_size'] + 2
+    max_position = max(config['seq_length'], config['max_seq_decoding'])
+    return Transformer(config['num_layers'], config['d_model'], config['num_heads'], config['dff'],
+                       vocab_size, vocab_size, pe_input=max_position, pe_target=max_position,
+                       rate=config['dropout'], recompute=recompute)
+
+def benchmark_pipeline(config):
+    """examples / sec of a shuffled token store source batched by sentences and by tokens"""
+    results = {}
+    with tempfile.TemporaryDirectory() as path:
+        start = time.time()
+        write_token_store(path, synthetic_examples(args.examples, config), config['dict_size'] + 1, {})
+        results['store_write_sec'] = time.time() - start
+        store = TokenStore(path, config['seq_length'])
+
+        for max_tokens in (0, args.max_tokens):
+            pipeline_args = argparse.Namespace(max_tokens=max_tokens, buffer_size=args.buffer_size,
+                                               shuffle_seed=args.seed, batch_size=args.batch_size, dev_cache='',
+                                               seq_length=config['seq_length'], jit_compile=False)
+            train_dataset, _ = prepare_datasets(store.get_dataset(shuffle=True, seed=args.seed),
+                                                store.get_dataset(), pipeline_args)
+            start, examples, batches = time.time(), 0, 0
+            for data, _ in train_dataset:
+                examples += int(data.shape[0])
+                batches += 1
+            elapsed = time.time() - start
+            name = 'token_batching' if max_tokens else 'sentence_batching'
+            results[name] = {'examples_per_sec': examples / elapsed, 'batches_per_sec': batches / elapsed}
+    return results
+
+def benchmark_train(config, recompute=False):
+    """construction and first step (tracing) time, then the time of the train steps
+    of transformer/steps.py"""
+    start = time.time()
+    model = get_model(config, recompute)
+    # recomputed layers can not create their variables in the train step
+    build_model(model)
+    optimizer = tf.keras.optimizers.Adam(1e-4, beta_1=0.9, beta_2=0.98, epsilon=1e-9)
+    construct_sec = time.time() - start
+    train_step = TracedFunction(get_train_step_fn(model, optimizer), 'train_step', step_signature)
+
+    batches = [synthetic_batch(config, args.batch_size) for _ in range(args.warmup_steps + args.steps)]
+    start = time.time()
+    run_train_step(train_step, batches[0])
+    first_step_sec = time.time() - start
+    for data in batches[1:args.warmup_steps]:
+        run_train_step(train_step, data)
+
+    durations, tokens = [], 0
+    for data in batches[args.warmup_steps:]:
+        start = time.time()
+        run_train_step(train_step, data)
+        durations.append(time.time() - start)
+        tokens += int(np.count_nonzero(data.numpy()))
+    results = {'construct_sec': construct_sec, 'first_step_sec': first_step_sec,
+               'step': get_latency_stats(durations),
+               'tokens_per_sec': tokens / sum(durations),
+               'examples_per_sec': args.steps * args.batch_size / sum(durations)}
+    return model, results
+
+def run_train_step(train_step, data):
+    # unpacked rows, the segments are not read
+    loss, _ = train_step(data, tf.zeros_like(data[:, 0]))
+    return loss.numpy()
+
+def decode_sentence(decode_step, config, source, beam_width):
+    """beam search of decode_length steps as transformer.generate_sentence_beam, without
+    stopping on finished beams so that every sentence runs the same nr of steps"""
+    start_token_id, end_token_id = config['dict_size'], config['dict_size'] + 1
+    output, _, _ = beam_decode(decode_step, [start_token_id] + source + [end_token_id], start_token_id,
+                               end_token_id, vocab_size=config['dict_size'] + 2, beam_width=beam_width,
+                               max_steps=args.decode_length, stop_when_finished=False)
+    return output
+
+def benchmark_decode(model, config):
+    """latency of a sentence and of a decoding step for each beam width, the first
+    sentence (tracing) is not timed"""
+    results = {}
+    decode_step = get_decode_step_fn(model)
+    for beam_width in (int(beam) for beam in args.beams.split(',')):
+        sources = [source for source, _ in synthetic_examples(args.sentences + 1, config)]
+        decode_sentence(decode_step, config, sources[0], beam_width)
+        durations = []
+        for source in sources[1:]:
+            start = time.time()
+            decode_sentence(decode_step, config, source, beam_width)
+            durations.append(time.time() - start)
+        results['beam_{}'.format(beam_width)] = dict(get_latency_stats(durations),
+            sentences_per_sec=len(durations) / sum(durations),
+            step_ms=1000 * sum(durations) / len(durations) / args.decode_length)
+    return results
+
+def benchmark_recompute(d_model):
+    """train step time and memory peak without and with --recompute_grad. the memory peak
+    is the one of the whole process, each case runs the train benchmark in a new process"""
+    results = {}
+    with tempfile.TemporaryDirectory() as path:
+        for recompute in (False, True):
+            output = os.path.join(path, 'recompute_{}.json'.format(recompute))
+            subprocess.check_call([sys.executable, '-m', 'benchmarks.suite', '--train_only',
+                '--recompute_grad={}'.format(recompute), '--presets={}'.format(d_model),
+                '--batch_size={}'.format(args.batch_size), '--warmup_steps={}'.format(args.warmup_steps),
+                '--steps={}'.format(args.steps), '--seed={}'.format(args.seed), '--output={}'.format(output)])
+            with open(output, 'rt') as f:
+                case = json.load(f)['presets'][str(d_model)]
+            results['on' if recompute else 'off'] = {'step': case['train']['step'],
+                                                     'memory_peak_mb': case['memory_peak_mb']}
+    results['step_time_ratio'] = results['on']['step']['mean_ms'] / results['off']['step']['mean_ms']
+    results['memory_peak_ratio'] = results['on']['memory_peak_mb'] / results['off']['memory_peak_mb']
+    return results
+
+def main(argv):
+    del argv
+    random.seed(args.seed)
+    tf.random.set_seed(args.seed)
+    report = {'time': time.time(), 'tf_version': tf.__version__, 'python': platform.python_version(),
+              'machine': platform.machine(), 'import_sec': IMPORT_END - IMPORT_START,
+              'options': {name: getattr(args, name) for name in ('batch_size', 'max_tokens', 'buffer_size',
+                          'examples', 'steps', 'sentences', 'decode_length', 'seed')},
+              'presets': {}}
+
+    for d_model in sorted(int(preset) for preset in args.presets.split(',')):
+        config = get_model_config(d_model)
+        tf.compat.v1.logging.info('benchmarking preset {}: {}'.format(d_model, config))
+        if args.train_only:
+            _, train = benchmark_train(config, args.recompute_grad)
+            report['presets'][str(d_model)] = {'config': config, 'train': train,
+                                               'memory_peak_mb': get_memory_peak_mb()}
+            continue
+        results = {'config': config, 'pipeline': benchmark_pipeline(config)}
+        model, results['train'] = benchmark_train(config)
+        results['decode'] = benchmark_decode(model, config)
+        # peak of the process so far, the presets run from the smallest one
+        results['memory_peak_mb'] = get_memory_peak_mb()
+        if args.recompute:
+            results['recompute'] = benchmark_recompute(d_model)
+        report['presets'][str(d_model)] = results
+        tf.compat.v1.logging.info('preset {}: {}'.format(d_model, json.dumps(results)))
+
+    with open(args.output, 'wt') as f:
+        json.dump(report, f, indent=2)
+    tf.compat.v1.logging.info('benchmark results written in {}'.format(args.output))
+
+if __name__ == "__main__":
+    tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.INFO)
+    absl_app.run(main)
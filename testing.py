@@ -14,7 +14,7 @@ import tensorflow as tf
 from absl import app as absl_app
 from bert.tokenization.bert_tokenization import FullTokenizer
 
-from transformer.dataset import construct_datasets_gec, construct_tokenizer, prepare_tensors,\
+from transformer.dataset import construct_tokenizer, prepare_tensors,\
         construct_datatset_numpy, prepare_datasets
 from transformer.utils import create_masks
 from transformer.transformer_bert import TransformerBert
@@ -15,15 +15,21 @@ from bert.tokenization.bert_tokenization import FullTokenizer
 import bert
 from collections import namedtuple
 
-from transformer.dataset import construct_datasets_gec, construct_tokenizer,\
-        construct_datatset_numpy, prepare_datasets, construct_tf_records
-from transformer.utils import create_masks
+from transformer.dataset import construct_flat_datasets, construct_tokenizer,\
+        construct_datatset_numpy, prepare_datasets, construct_tf_records, get_datasets_info
+from transformer.utils import unique_variables
+from transformer.steps import build_model, get_train_step_fn, get_eval_step_fn, get_decode_step_fn, beam_decode
 from transformer.transformer_bert import TransformerBert
 from transformer.transformer import Transformer
 from transformer.transformer_scheduler import CustomSchedule
+from transformer.metrics import StepMetrics, write_metrics
+from transformer.jit import TracedFunction, enable_jit
+from transformer.profiling import Profiler
+from transformer.presets import MODEL_DEFAULTS, apply_model_presets
+from transformer.checkpointing import AsyncCheckpointer, write_inference_checkpoint, load_inference_checkpoint
+from transformer.distribute import get_strategy, get_worker_path, run_on_replicas, distribute_datasets
 from transformer.serialization import get_ids_dataset_tf_records, upload_blob,\
-                                        get_tokenizers_ckeckpoint
-import beam_search
+                                        get_tokenizers_ckeckpoint, read_manifest, get_manifest_files
 
 
 # TPU cloud params
@@ -43,6 +49,9 @@ tf.compat.v1.flags.DEFINE_string(
     "specified, we will attempt to automatically detect the GCE project from "
     "metadata.")
 tf.compat.v1.flags.DEFINE_bool("use_tpu", False, "Use TPUs rather than plain CPUs")
+tf.compat.v1.flags.DEFINE_string('distribution', default='',
+                        help='data parallel training without tpu: mirrored (devices of this machine), '
+                        'multi_worker (one process per worker, cluster in TF_CONFIG) or none if empty')
 tf.compat.v1.flags.DEFINE_string('bucket', default='ro-gec', help='path from where to load bert')
 
 
@@ -54,6 +63,18 @@ tf.compat.v1.flags.DEFINE_string('checkpoint', default='checkpoints/ronac_transf
 tf.compat.v1.flags.DEFINE_string('bert_model_dir', default='bert/bert_ro_256/', help='path from where to load bert')
 tf.compat.v1.flags.DEFINE_string('tf_records', default='corpora/tf_records/transformer_finetune_128', help='path to tf records folder')
 tf.compat.v1.flags.DEFINE_string('info', default='info.log', help='path to tf info file')
+tf.compat.v1.flags.DEFINE_string('metrics_file', default='metrics.jsonl',
+                        help='json lines file of the train / dev metrics')
+tf.compat.v1.flags.DEFINE_integer('record_shards', default=128,
+                        help='nr of tf records files for each split, the train shards are the unit of the shuffle')
+tf.compat.v1.flags.DEFINE_integer('num_workers', default=0,
+                        help='processes used to build the datasets, 0 for one per cpu')
+tf.compat.v1.flags.DEFINE_string('record_compression', default='',
+                        help='compression of the tf records: GZIP, ZLIB or none if empty')
+tf.compat.v1.flags.DEFINE_string('record_dtype', default='int64',
+                        help='type of the ids in the tf records: int64, uint16 or int32 (stored as bytes)')
+tf.compat.v1.flags.DEFINE_bool('pad_records', default=True,
+                        help='store the tf records padded to seq_length, unpadded rows are padded when read')
 
 # mode of execution
 """if bert is used, the decoder is still a transofrmer with transformer specific tokenization"""
@@ -64,23 +85,67 @@ tf.compat.v1.flags.DEFINE_bool('decode_mode',default=False, help='do prediction,
 tf.compat.v1.flags.DEFINE_bool('separate', default=True, help='separate dev and training dataset')
 tf.compat.v1.flags.DEFINE_bool('use_bucket', default=False, help='use checkpoints from bucket')
 tf.compat.v1.flags.DEFINE_bool('use_txt', default=False, help='use txt files for datasets')
+tf.compat.v1.flags.DEFINE_string('token_store', default='',
+                        help='folder of the tokenized txt datasets, next to each txt file if empty')
+tf.compat.v1.flags.DEFINE_bool('bert_cache', default=False,
+                        help='with bert and use_txt, compute the frozen bert encoder outputs once in the token store '
+                        'and train the decoder from them')
+tf.compat.v1.flags.DEFINE_bool('bert_cache_fp16', default=True, help='store the cached bert encoder outputs as float16')
 
 # model params
-tf.compat.v1.flags.DEFINE_integer('num_layers', default=6, help='')
+tf.compat.v1.flags.DEFINE_integer('num_layers', default=MODEL_DEFAULTS['num_layers'], help='')
 tf.compat.v1.flags.DEFINE_integer('d_model', default=768,
                         help='d_model size is the out of the embeddings, it must match the bert model size, if you use one')
-tf.compat.v1.flags.DEFINE_integer('seq_length', default=512, help='same as d_model')
-tf.compat.v1.flags.DEFINE_integer('dff', default=2048, help='')
-tf.compat.v1.flags.DEFINE_integer('num_heads', default=8, help='')
-tf.compat.v1.flags.DEFINE_float('dropout', default=0.1, help='')
-tf.compat.v1.flags.DEFINE_integer('dict_size', default=(2**15), help='')
+tf.compat.v1.flags.DEFINE_integer('seq_length', default=MODEL_DEFAULTS['seq_length'], help='same as d_model')
+tf.compat.v1.flags.DEFINE_integer('dff', default=MODEL_DEFAULTS['dff'], help='')
+tf.compat.v1.flags.DEFINE_integer('num_heads', default=MODEL_DEFAULTS['num_heads'], help='')
+tf.compat.v1.flags.DEFINE_float('dropout', default=MODEL_DEFAULTS['dropout'], help='')
+tf.compat.v1.flags.DEFINE_integer('dict_size', default=MODEL_DEFAULTS['dict_size'], help='')
+tf.compat.v1.flags.DEFINE_float('vocab_sample', default=1.0,
+                        help='fraction of the dataset lines counted to build the subwords vocabulary')
 tf.compat.v1.flags.DEFINE_integer('epochs', default=500, help='')
 tf.compat.v1.flags.DEFINE_integer('buffer_size', default=(128), help='')
+tf.compat.v1.flags.DEFINE_integer('shuffle_seed', default=None,
+                        help='seed of the training data order, reproducible across runs when set')
+tf.compat.v1.flags.DEFINE_string('dev_cache', default='',
+                        help='file caching the dev batches, in memory if empty')
 tf.compat.v1.flags.DEFINE_integer('batch_size', default=32, help='')
+tf.compat.v1.flags.DEFINE_integer('max_tokens', default=0,
+                        help='if > 0, batch by a budget of source + target tokens instead of batch_size sentences')
+tf.compat.v1.flags.DEFINE_bool('pack', default=False,
+                        help='pack several short source / target pairs in one row of seq_length tokens')
 tf.compat.v1.flags.DEFINE_float('train_dev_split', default=1.0, help='')
 tf.compat.v1.flags.DEFINE_integer('total_samples', default=10000000, help='')
 tf.compat.v1.flags.DEFINE_bool('show_batch_stats', default=True, help='do prediction, decoding')
+tf.compat.v1.flags.DEFINE_integer('log_every', default=1000, help='train batches between two metrics logs, 0 to log only at the end of the epoch')
+tf.compat.v1.flags.DEFINE_bool('profile', default=False,
+                        help='time the phases of training (data wait / step) and decoding, report throughput and latencies')
+tf.compat.v1.flags.DEFINE_string('profile_report', default='profile.jsonl',
+                        help='json lines file of the profile reports (each train epoch, end of decoding)')
+tf.compat.v1.flags.DEFINE_string('profile_trace_dir', default='',
+                        help='if set, tf profiler trace of the profile_trace_steps window written in this dir')
+tf.compat.v1.flags.DEFINE_string('profile_trace_steps', default='10,20',
+                        help='first,last train batch (or decoded sentence) of the profiler trace')
+tf.compat.v1.flags.DEFINE_integer('steps_per_call', default=1,
+                        help='train steps run by one call of the compiled function (not on tpu)')
+tf.compat.v1.flags.DEFINE_bool('jit_compile', default=False,
+                        help='xla compile the train, eval and decode steps, lengths are bucketed')
 tf.compat.v1.flags.DEFINE_bool('reset_opt', default=False, help='reset optimizer when training')
+tf.compat.v1.flags.DEFINE_string('export_inference', default='',
+                        help='dir where the latest checkpoint is exported without the optimizer state, for decoding')
+tf.compat.v1.flags.DEFINE_bool('export_fp16', default=False, help='export the inference weights as float16')
+tf.compat.v1.flags.DEFINE_string('inference_checkpoint', default='',
+                        help='decode with the exported inference checkpoint of this dir instead of checkpoint_path')
+tf.compat.v1.flags.DEFINE_integer('checkpoint_steps', default=0,
+                        help='train batches between two checkpoints, 0 to save only every 2 epochs')
+tf.compat.v1.flags.DEFINE_bool('save_iterator', default=False,
+                        help='save the train data iterator in the checkpoints (includes the shuffle buffer, '
+                        'tf records only, not with use_txt or distribution), otherwise the batches already '
+                        'trained in the epoch are skipped on restart')
+tf.compat.v1.flags.DEFINE_bool('tie_embeddings', default=False,
+                        help='share encoder / decoder embeddings and the output projection (decoder side only with bert)')
+tf.compat.v1.flags.DEFINE_bool('recompute_grad', default=False,
+                        help='recompute encoder / decoder layer activations in the backward pass to save memory')
 
 # deconding 100k_wiki_clean.arpa 30m_wiki_clean.arpa
 tf.compat.v1.flags.DEFINE_integer('beam', default=8, help='beam width')
@@ -89,7 +154,7 @@ tf.compat.v1.flags.DEFINE_string('lm_path', default='/media/teo/drive hdd/gec/co
 tf.compat.v1.flags.DEFINE_bool('normalize_lm', default=False, help='normalize reranking by sentence length')
 tf.compat.v1.flags.DEFINE_bool('normalize_beam', default=False, help='normalize  beam by length')
 tf.compat.v1.flags.DEFINE_bool('lm', default=False, help='use language model for reranking')
-tf.compat.v1.flags.DEFINE_integer('max_seq_decoding', default=768, help='max length of the decoding sequence')
+tf.compat.v1.flags.DEFINE_integer('max_seq_decoding', default=MODEL_DEFAULTS['max_seq_decoding'], help='max length of the decoding sequence')
 tf.compat.v1.flags.DEFINE_float('weight_lm', default=1., help='weight of the LM in decoding (should be in [0, 2])')
 
 # for prediction purposes only
@@ -111,37 +176,68 @@ else:
     args.checkpoint_path = args.checkpoint
 
 
-if args.d_model == 64:
-    args.seq_length = 64
-    args.dff = 64
-    args.num_heads = 2
-    args.num_layers = 2
-    args.max_seq_decoding = 64
-    args.dict_size = 1024
-    args.dropout = 0.2
-elif args.d_model == 128:
-    args.seq_length = 128
-    args.dff = 128
-    args.num_heads = 2
-    args.num_layers = 3
-    args.max_seq_decoding = 128
-    args.dict_size = 2048
-    args.dropout = 0.2
-elif args.d_model == 256:
-    args.seq_length = 256 
-elif args.d_model == 768:
-    args.seq_length = 512
+apply_model_presets(args)
 
 if args.decode_mode:
     args.batch_size = args.beam
+
+if args.use_tpu and args.max_tokens:
+    tf.compat.v1.logging.warning('token batching has dynamic shapes, not supported on tpu, using batch_size')
+    args.max_tokens = 0
+
+if args.distribution and args.max_tokens:
+    # the replicas would run a different nr of token batches and wait for each other
+    tf.compat.v1.logging.warning('token batching not supported with distribution, using batch_size')
+    args.max_tokens = 0
+
+if args.distribution == 'multi_worker' and args.shuffle_seed is None:
+    # each worker takes its shard of the same shuffled order
+    tf.compat.v1.logging.warning('multi_worker training needs the same shuffle on every worker, shuffle_seed 0')
+    args.shuffle_seed = 0
+
+if args.bert and args.pack:
+    tf.compat.v1.logging.warning('bert encoder has no segment aware attention, packing disabled')
+    args.pack = False
+
+if args.bert_cache and (not args.bert or not args.use_txt or args.records):
+    tf.compat.v1.logging.warning('bert encoder outputs are cached in the token store, only with bert and use_txt')
+    args.bert_cache = False
+
+if args.bert_cache and args.max_tokens:
+    tf.compat.v1.logging.warning('token batching not supported with the bert encoder cache, using batch_size')
+    args.max_tokens = 0
+
+if (args.use_tpu or args.distribution) and args.save_iterator:
+    tf.compat.v1.logging.warning('distributed iterators can not be saved, batches are skipped on restart')
+    args.save_iterator = False
+
+if args.use_txt and args.save_iterator:
+    tf.compat.v1.logging.warning('the token store is read by numpy_function, its iterator can not be saved, '
+                                 'batches are skipped on restart')
+    args.save_iterator = False
+
+if args.use_tpu and args.jit_compile:
+    tf.compat.v1.logging.warning('tpu steps are always compiled by xla, jit_compile ignored')
+    args.jit_compile = False
+enable_jit(args.jit_compile)
     
 tokenizer_pt, tokenizer_en, tokenizer_ro, tokenizer_bert = None, None, None, None
 transformer, optimizer = None, None
+decode_step = None
 lm_model = None
 eval_loss, eval_accuracy = None, None
 strategy = None
-train_step_signature = [tf.TensorSpec(shape=(None, 2, args.seq_length), dtype=tf.int64),
-    tf.TensorSpec(shape=(None, args.seq_length), dtype=tf.int64)]
+profiler = Profiler(args.profile, args.profile_trace_dir, args.profile_trace_steps)
+# token batching trims the padding of each batch, the sequence length varies
+seq_dim = None if args.max_tokens else args.seq_length
+# packed rows have segments for both the source and the target
+segs_shape = (None, 2, seq_dim) if args.pack else (None, seq_dim)
+train_step_signature = [tf.TensorSpec(shape=(None, 2, seq_dim), dtype=tf.int64),
+    tf.TensorSpec(shape=segs_shape, dtype=tf.int64)]
+if args.bert_cache:
+    # cached bert encoder outputs
+    train_step_signature.append(tf.TensorSpec(shape=(None, seq_dim, None),
+                                              dtype=tf.float16 if args.bert_cache_fp16 else tf.float32))
 eval_step_signature = train_step_signature
 
 
@@ -157,13 +253,18 @@ class Beam(namedtuple("Beam", ["log_prob", "ids", "length"])):
 
 def correct_from_file(in_file: str, out_file: str):
     with open(in_file, 'r', encoding='utf-8') as fin, open(out_file, 'w', encoding='utf-8') as fout:
-        for line in fin:
+        profiler.reset()
+        for i, line in enumerate(fin):
+            profiler.step(i)
             print('original: ', line)
-            predicted_sentence = correct_gec(line)
+            with profiler.phase('sentence'):
+                predicted_sentence = correct_gec(line)
+            profiler.count(sentences=1)
             print('written: ', predicted_sentence)
             fout.write(predicted_sentence.strip())
             fout.write('\n')
             fout.flush()
+    profiler.log_report('decode', args.profile_report, beam=args.beam)
            
 
 def correct_gec(sentence: str, plot=''):
@@ -176,16 +277,22 @@ def correct_gec(sentence: str, plot=''):
         
     beams, attention_weights = generate_sentence_beam(sentence)
 
+    with profiler.phase('detokenize'):
+        beams_ids = []
+        for beam in beams:
+            sentence_ids = []
+            for i in beam.ids:
+                if i < tokenizer_ro.vocab_size:
+                    sentence_ids.append(i)
+                if i == tokenizer_ro.vocab_size + 1:
+                    break
+            beams_ids.append(sentence_ids)
+        predicted_sentences = tokenizer_ro.decode_batch(beams_ids)
+
     candidates = []
-    for beam in beams:
-        sentence_ids = []
-        for i in beam.ids:
-            if i < tokenizer_ro.vocab_size:
-                sentence_ids.append(i)
-            if i == tokenizer_ro.vocab_size + 1:
-                break
-        predicted_sentence = tokenizer_ro.decode(sentence_ids)
-        lm_prob = lm_model.score(predicted_sentence, bos=True, eos=True)
+    for beam, predicted_sentence in zip(beams, predicted_sentences):
+        with profiler.phase('lm_score'):
+            lm_prob = lm_model.score(predicted_sentence, bos=True, eos=True)
         if args.lm:
             if args.normalize_lm:
                 cand_prob = beam.log_prob + 10 * args.weight_lm * lm_prob * (1.0/beam.length)
@@ -201,101 +308,55 @@ def correct_gec(sentence: str, plot=''):
     print('chosen: ', candidates[0][1])
     return candidates[0][1]
 
-def init_beam(vocab_size, end_token_id, beam_width=1):
-    
-    length_penalty = 0.6 if args.normalize_beam else 0.0
-    config = beam_search.BeamSearchConfig(
-        beam_width=beam_width,
-        vocab_size=vocab_size,
-        eos_token=end_token_id,
-        length_penalty_weight=length_penalty,
-        choose_successors_fn=beam_search.choose_top_k)
-
-    beam_state = beam_search.BeamSearchState(
-        log_probs=tf.nn.log_softmax(tf.ones(config.beam_width)),
-        lengths=tf.constant(
-            1, shape=[config.beam_width], dtype=tf.int32),
-        finished=tf.zeros(
-            [config.beam_width], dtype=tf.bool))
-    return config, beam_state
-
 def generate_sentence_beam(inp_sentence: str):
-    global tokenizer_ro, tokenizer_bert, transformer, optimizer, args
+    global tokenizer_ro, tokenizer_bert, transformer, optimizer, args, decode_step
     inp_sentence = inp_sentence.strip()
     
     if tokenizer_ro is None or (args.bert and tokenizer_bert is None):
-        tokenizer_ro, tokenizer_bert = get_tokenizers_ckeckpoint(args)
+        tokenizer_ro, tokenizer_bert = get_tokenizers_ckeckpoint(args, args.inference_checkpoint)
+
+    if transformer is None and args.inference_checkpoint:
+        # no optimizer nor learning rate schedule, weights only
+        transformer, optimizer = get_model_gec(with_optimizer=False)
+        build_model(transformer, args.bert)
+        manifest = load_inference_checkpoint(get_inference_variables(transformer), args.inference_checkpoint)
+        tf.compat.v1.logging.info('inference checkpoint restored {} (fp16 {})'.format(
+            args.inference_checkpoint, manifest['fp16']))
 
     if transformer is None:
         transformer, optimizer = get_model_gec()
-        if args.bert:
-            ckpt = tf.train.Checkpoint(decoder=transformer.decoder, 
-                final_layer=transformer.final_layer, optimizer=optimizer)
-        else:
-            ckpt = tf.train.Checkpoint(transformer=transformer, optimizer=optimizer)
+        ckpt = get_checkpoint(transformer, optimizer)
         
         ckpt_manager = tf.train.CheckpointManager(ckpt, args.checkpoint_path, max_to_keep=5)
         if ckpt_manager.latest_checkpoint:
             # loading mechanis matches variables from the tf graph and resotres their values
-            ckpt.restore(ckpt_manager.latest_checkpoint)
+            restore_checkpoint(ckpt, ckpt_manager.latest_checkpoint, transformer)
         else:
             tf.compat.v1.logging.error('no checkpoints for transformers, aborting')
             return None
 
     start_token, end_token = [tokenizer_ro.vocab_size], [tokenizer_ro.vocab_size + 1]
-    if args.bert:
-        inp_sentence = tokenizer_bert.convert_tokens_to_ids(['[CLS]'] +
-             tokenizer_bert.tokenize(inp_sentence) + ['[SEP]'])
-    else:
-        in_sentence = inp_sentence
-        inp_sentence = start_token + tokenizer_ro.encode(inp_sentence) + end_token
-        # print(tokenizer_ro.encode(in_sentence))
-    start_token_id, end_token_id = tokenizer_ro.vocab_size, tokenizer_ro.vocab_size + 1
-
-    # duplicate x beam_width == batch size
-    encoder_input = tf.expand_dims(inp_sentence, 0)
-    encoder_input = tf.tile(encoder_input, [args.beam, 1])
-
-    decoder_input = [start_token_id] * args.beam
-    output = tf.expand_dims(decoder_input, 1) # for batch size == beam_wisth
-
-    # beam search init 
-    config, beam_state = init_beam(vocab_size=(args.dict_size + 2),
-                                                end_token_id=end_token_id, 
-                                                beam_width=args.beam)
-    beam_values = tf.constant(start_token_id, shape=(1, args.beam))
-    beam_parents = tf.zeros((2, args.beam), dtype=tf.int32)
-
-    for i in range(args.max_seq_decoding):
-        enc_padding_mask, combined_mask, dec_padding_mask = create_masks(
-            encoder_input, output)
-
+    with profiler.phase('tokenize'):
         if args.bert:
-            inp_seg = tf.zeros(shape=encoder_input.shape, dtype=tf.dtypes.int64)
-            predictions, attention_weights = transformer(encoder_input, inp_seg, output,
-                                                        False, enc_padding_mask, combined_mask,
-                                                        dec_padding_mask)
+            inp_sentence = tokenizer_bert.convert_tokens_to_ids(['[CLS]'] +
+                 tokenizer_bert.tokenize(inp_sentence) + ['[SEP]'])
         else:
-            predictions, attention_weights = transformer(encoder_input, output,
-                                                            False, enc_padding_mask,
-                                                            combined_mask, dec_padding_mask)
-        # !predictions.shape == (batch_size, i, vocab_size) (predicts a softmax for each existing word!)
-        beam_pred = tf.squeeze(predictions[: ,-1:, :], 1)  # (batch_size, 1, vocab_size), select only the last word
-        bs_output, beam_state = beam_search.beam_search_step(time_=i, logits=beam_pred,
-                                                             beam_state=beam_state, config=config)
-
-        # add new predictions to the beams decoder
-        bs_output_predicted_ids = tf.expand_dims(bs_output.predicted_ids, axis=0)
-        beam_values = tf.concat([beam_values, bs_output_predicted_ids], axis=0)
-        res = tf.cast(beam_search.gather_tree_py(beam_values.numpy(), beam_parents.numpy()), dtype=tf.int32)
-        output = tf.transpose(res)
-
-        bs_output_beam_parent_ids = tf.expand_dims(bs_output.beam_parent_ids, axis=0)
-        beam_parents = tf.concat([beam_parents, bs_output_beam_parent_ids], axis=0)
-
-        all_finished = tf.reduce_all(beam_state.finished) # and
-        if all_finished:    break
+            in_sentence = inp_sentence
+            inp_sentence = start_token + tokenizer_ro.encode(inp_sentence) + end_token
+            inp_sentence = inp_sentence[:get_max_position()]
+            # print(tokenizer_ro.encode(in_sentence))
+    start_token_id, end_token_id = tokenizer_ro.vocab_size, tokenizer_ro.vocab_size + 1
+
+    if decode_step is None:
+        decode_step_fn = get_decode_step_fn(transformer, args.bert)
+        decode_step = TracedFunction(decode_step_fn, 'decode_step', jit_compile=True) if args.jit_compile\
+            else decode_step_fn
+    output, beam_state, attention_weights = beam_decode(decode_step, inp_sentence, start_token_id, end_token_id,
+        vocab_size=args.dict_size + 2, beam_width=args.beam, max_steps=args.max_seq_decoding,
+        normalize_beam=args.normalize_beam, pad_length=get_max_position() if args.jit_compile else 0,
+        pad_input=not args.bert, profiler=profiler)
 
+    profiler.count(input_tokens=len(inp_sentence), output_tokens=int(output.shape[1]) - 1)
     beams = []
     for i, out in enumerate(output):
         b = Beam(log_prob=beam_state.log_probs[i].numpy(), ids=out.numpy(), length=len(out.numpy()))
@@ -303,69 +364,119 @@ def generate_sentence_beam(inp_sentence: str):
 
     return beams, attention_weights # return one of them
 
-def get_model_gec():
+def get_max_position():
+    """longest sequence seen by the encoder or the decoder, in training or decoding"""
+    return max(args.seq_length, args.max_seq_decoding)
+
+def get_model_gec(with_optimizer=True, cached_encoder=False):
+    """with cached_encoder the bert model is given the cached encoder outputs, bert is not built"""
     global args, transformer, tokenizer_ro
 
     vocab_size = args.dict_size + 2
+    max_position = get_max_position()
 
-    learning_rate = CustomSchedule(args.d_model)
-    optimizer = tf.keras.optimizers.Adam(learning_rate, beta_1=0.9, beta_2=0.98, 
-                                     epsilon=1e-9)
+    optimizer = None
+    if with_optimizer:
+        learning_rate = CustomSchedule(args.d_model)
+        optimizer = tf.keras.optimizers.Adam(learning_rate, beta_1=0.9, beta_2=0.98, 
+                                         epsilon=1e-9)
 
     if args.bert is True:
         transformer = TransformerBert(args.num_layers, args.d_model, args.num_heads, args.dff,
                             vocab_size, vocab_size,
                             model_dir=args.bert_model_dir, 
-                            pe_input=vocab_size, 
-                            pe_target=vocab_size,
-                            rate=args.dropout, args=args)
+                            pe_input=max_position, 
+                            pe_target=max_position,
+                            rate=args.dropout, args=args,
+                            recompute=args.recompute_grad,
+                            tie_embeddings=args.tie_embeddings,
+                            cached_encoder=cached_encoder)
         tf.compat.v1.logging.info('transformer bert loaded')
     else:
         transformer = Transformer(args.num_layers, args.d_model, args.num_heads, args.dff,
                             vocab_size, vocab_size, 
-                            pe_input=vocab_size, 
-                            pe_target=vocab_size,
-                            rate=args.dropout)
+                            pe_input=max_position, 
+                            pe_target=max_position,
+                            rate=args.dropout,
+                            recompute=args.recompute_grad,
+                            tie_embeddings=args.tie_embeddings)
     tf.compat.v1.logging.info('transformer model constructed')
     
     return transformer, optimizer
 
-def loss_function(real, pred):
-    loss_object = tf.keras.losses.SparseCategoricalCrossentropy(
-        from_logits=True, reduction=tf.keras.losses.Reduction.NONE)
-    
-    # mask to compute loss
-    mask = tf.math.logical_not(tf.math.equal(real, 0))
-    loss_ = loss_object(real, pred)
-
-    mask = tf.cast(mask, dtype=tf.float32)
-    loss_ *= mask
-    loss_ = tf.cast(loss_, dtype=tf.float32)
-    loss_sum = tf.cast(tf.reduce_sum(loss_), tf.float32)
-    mask_sum = tf.cast(tf.reduce_sum(mask), tf.float32)
-
-    loss_reduced = tf.divide(loss_sum, mask_sum)
-    return loss_reduced
-
-def acc_function(real, pred):
-    pred_targets = tf.math.argmax(pred, axis=-1)
-    pred_targets = tf.cast(pred_targets, tf.int64)
-    
-    eq = tf.equal(pred_targets, real)
-    eq = tf.cast(eq, tf.int64)
-
-    mask = tf.math.logical_not(tf.math.equal(real, 0))
-    mask = tf.cast(mask, tf.int64)
-
-    sum_mask = tf.cast(tf.reduce_sum(mask), tf.float32)
-    sum_masked_eq = tf.cast(tf.reduce_sum(eq * mask), tf.float32)
-    accuracy = tf.divide(sum_masked_eq, sum_mask)
-    return accuracy
-
+def get_checkpoint_objects(transformer):
+    """with bert only the decoder side is trained"""
+    if args.bert:
+        objects = {'decoder': transformer.decoder}
+        if transformer.final_layer is not None:
+            objects['final_layer'] = transformer.final_layer
+        return objects
+    return {'transformer': transformer}
+
+def get_checkpoint(transformer, optimizer, **state):
+    """objects saved in the checkpoints, state is the position of the training
+    (epoch, batch and iterator)"""
+    return tf.train.Checkpoint(optimizer=optimizer, **get_checkpoint_objects(transformer), **state)
+
+def get_inference_variables(transformer):
+    """variables of the checkpoint objects in creation order, tied embeddings once"""
+    objects = get_checkpoint_objects(transformer)
+    return unique_variables([variable for name in sorted(objects) for variable in objects[name].variables])
+
+def export_inference_checkpoint():
+    """writes the weights of the latest checkpoint without the optimizer state, with the
+    tokenizers and the model options"""
+    transformer, _ = get_model_gec(with_optimizer=False)
+    build_model(transformer, args.bert)
+    latest_checkpoint = tf.train.latest_checkpoint(args.checkpoint_path)
+    if not latest_checkpoint:
+        tf.compat.v1.logging.error('no checkpoint to export in {}'.format(args.checkpoint_path))
+        return
+    # the optimizer slots of the checkpoint are not loaded
+    tf.train.Checkpoint(**get_checkpoint_objects(transformer)).restore(latest_checkpoint).expect_partial()
+
+    config = {name: getattr(args, name) for name in ('num_layers', 'd_model', 'num_heads', 'dff',
+                  'dict_size', 'seq_length', 'max_seq_decoding', 'bert', 'tie_embeddings')}
+    files = [os.path.join(args.checkpoint, name) for name in ('tokenizer_ro.subwords', 'tokenizer_bert.vocab')]
+    files = [path for path in files if tf.io.gfile.exists(path)]
+    manifest = write_inference_checkpoint(get_inference_variables(transformer), args.export_inference,
+                                          fp16=args.export_fp16, config=config, files=files)
+    tf.compat.v1.logging.info('inference checkpoint of {} exported to {}: {} variables, {} bytes'.format(
+        latest_checkpoint, args.export_inference, len(manifest['variables']), manifest['bytes']))
+
+def restore_checkpoint(ckpt, path, transformer):
+    untied = args.tie_embeddings and not args.bert and get_untied_variables(path)
+    if untied:
+        # created before the restores, a deferred restore would run after the one of the encoder embedding
+        build_model(transformer, args.bert)
+    status = ckpt.restore(path)
+    if args.tie_embeddings:
+        # untied checkpoints also load, their decoder embedding and output layer are unused
+        status.expect_partial()
+    if untied:
+        # the encoder and the decoder embedding of the checkpoint both restore the shared embedding,
+        # the encoder one is restored again so that it is the one kept
+        encoder = tf.train.Checkpoint(embedding=transformer.encoder.embedding)
+        tf.train.Checkpoint(transformer=tf.train.Checkpoint(encoder=encoder)).restore(path).expect_partial()
+        tf.compat.v1.logging.info('untied checkpoint {} restored with tied embeddings, the encoder embedding '
+                                  'is kept, dropped: {}'.format(path, ', '.join(untied)))
+        if not args.reset_opt:
+            tf.compat.v1.logging.warning('the optimizer slots of the shared embedding may be the ones of the '
+                                         'decoder embedding, --reset_opt starts them over')
+    return status
+
+def get_untied_variables(path):
+    """variables of an untied (non bert) checkpoint without a place in a tied model: the
+    decoder embedding and the output layer. empty for a tied checkpoint, which has no output layer"""
+    names = [name for name, _ in tf.train.list_variables(path)]
+    if not any(name.startswith('transformer/final_layer/') for name in names):
+        return []
+    return [name for name in names if name.startswith(('transformer/decoder/embedding/', 'transformer/final_layer/'))
+            and '/.OPTIMIZER_SLOT/' not in name]
 
 def print_stats(args, epoch, stage, batch_idx, loss, acc, log):
     if batch_idx is not None:
-        if args.show_batch_stats and (batch_idx + 1) % 100000 == 0:
+        if args.show_batch_stats:
             tf.compat.v1.logging.info('{} - epoch {} batch {} loss {:.4f} accuracy {:.4f}'.format(
                                 stage, epoch + 1, batch_idx, loss, acc))
             log.write('{} - epoch {} batch {} loss {:.4f} accuracy {:.4f}\n'.format(
@@ -381,121 +492,89 @@ def print_stats(args, epoch, stage, batch_idx, loss, acc, log):
 def train_gec():
     global args, optimizer, transformer, strategy
     
-    @tf.function(input_signature=train_step_signature)
-    def train_step(data, inp_segs):
-        global transformer, optimizer, strategy
-        # batch, seq_length
-        inp, tar = data[:, 0], data[:, 1]
-        tar_inp = tar[:, :-1]
-        tar_real = tar[:, 1:]
-        enc_padding_mask, combined_mask, dec_padding_mask = create_masks(inp, tar_inp)
-        
-        with tf.GradientTape() as tape:
-            if args.bert is True:
-                predictions, _ = transformer(inp, inp_segs, tar_inp, 
-                                        True, 
-                                        enc_padding_mask, 
-                                        combined_mask, 
-                                        dec_padding_mask)
-            else:
-                predictions, _ = transformer(inp, tar_inp, 
-                                        True, 
-                                        enc_padding_mask, 
-                                        combined_mask, 
-                                        dec_padding_mask)
-            loss = loss_function(tar_real, predictions)
-        
-        gradients = tape.gradient(loss, transformer.trainable_variables)
-        optimizer.apply_gradients(zip(gradients, transformer.trainable_variables))
-
-        acc = acc_function(tar_real, predictions)
-
-        tf.compat.v1.logging.info('transformer summary: {}'.format(transformer.summary()))
-        return loss, acc
-
-    @tf.function(input_signature=eval_step_signature)
-    def eval_step(data, inp_segs):
-        global transformer, optimizer, eval_accuracy, eval_loss
-        inp, tar = data[:, 0], data[:, 1]
-        tar_inp = tar[:, :-1]
-        tar_real = tar[:, 1:]
-        enc_padding_mask, combined_mask, dec_padding_mask = create_masks(inp, tar_inp)
-
-        with tf.GradientTape() as tape:
-            if args.bert:
-                predictions, _ = transformer(inp, inp_segs, tar_inp, 
-                                        False, 
-                                        enc_padding_mask, 
-                                        combined_mask, 
-                                        dec_padding_mask)
+    # accumulated by the steps, created before they are traced
+    train_metrics, eval_metrics = StepMetrics('train'), StepMetrics('dev')
+
+    # workers other than the chief write their logs and checkpoints to a temporary dir
+    if args.dev_cache:
+        args.dev_cache = get_worker_path(args.dev_cache)
+
+    with open(get_worker_path(args.info), 'wt') as log,\
+            open(get_worker_path(args.metrics_file), 'at') as metrics_log:
+        # epoch and nr of its batches already trained, where a restart resumes. read before
+        # the datasets are built, the train order depends on the epoch
+        epoch_var = tf.Variable(0, dtype=tf.int64, trainable=False)
+        batch_var = tf.Variable(0, dtype=tf.int64, trainable=False)
+        latest_checkpoint = tf.train.latest_checkpoint(args.checkpoint_path)
+        if latest_checkpoint:
+            tf.train.Checkpoint(epoch=epoch_var, batch=batch_var).restore(latest_checkpoint).expect_partial()
+        start_epoch, start_batch = int(epoch_var.numpy()), int(batch_var.numpy())
+        if start_batch and not args.save_iterator and args.shuffle_seed is None:
+            # the order of the interrupted epoch can not be rebuilt, skipping batches of another
+            # order would repeat some examples and drop others
+            tf.compat.v1.logging.warning('no --shuffle_seed, epoch {} is restarted from its first batch '
+                                         'instead of after {} batches'.format(start_epoch + 1, start_batch))
+            start_batch = 0
+
+        def get_rows():
+            """nr of train / dev rows for the distributed datasets"""
+            datasets_info = get_datasets_info(args)
+            return [datasets_info.get(split, {}).get('rows') for split in ('train', 'dev')]
+
+        def build_datasets(epoch, skip_batches=0):
+            """train and dev batches, the train order is the one of epoch (shuffle_seed + epoch).
+            the first skip_batches train batches are dropped inside the pipeline"""
+            if args.use_txt:
+                train_dataset, dev_dataset = construct_flat_datasets(args, args.subwords_path, epoch)
             else:
-                predictions, _ = transformer(inp, tar_inp, 
-                                        False, 
-                                        enc_padding_mask, 
-                                        combined_mask, 
-                                        dec_padding_mask)
-            loss = loss_function(tar_real, predictions)
-        acc = acc_function(tar_real, predictions)
-        return loss, acc 
-
-    @tf.function
-    def distributed_train_step(dataset_inputs):
-        data, segs = dataset_inputs
-        per_example_losses, per_example_accs = strategy.experimental_run_v2(train_step, args=(data, segs))
-
-        per_example_losses = tf.stack(per_example_losses.values, axis=0)
-        per_example_accs = tf.stack(per_example_accs.values, axis=0)
-
-        mean_loss = strategy.reduce(tf.distribute.ReduceOp.MEAN, per_example_losses, axis=0)
-        mean_acc = strategy.reduce(tf.distribute.ReduceOp.MEAN, per_example_accs, axis=0)
-        return mean_loss, mean_acc
-
-    @tf.function
-    def distributed_eval_step(dataset_inputs):
-        data, segs = dataset_inputs
-        per_example_losses, per_example_accs = strategy.experimental_run_v2(eval_step, args=(data, segs))
-
-        per_example_losses = tf.stack(per_example_losses.values, axis=0)
-        per_example_accs = tf.stack(per_example_accs.values, axis=0)
-
-        mean_loss = strategy.reduce(tf.distribute.ReduceOp.MEAN, per_example_losses, axis=0)
-        mean_acc = strategy.reduce(tf.distribute.ReduceOp.MEAN, per_example_accs, axis=0)
-        return mean_loss, mean_acc
-
-    with open(args.info, 'wt') as log:
-        if args.use_txt:
-            train_dataset, dev_dataset = construct_datasets_gec(args, args.subwords_path)
-        else:
-            train_dataset, dev_dataset, = get_ids_dataset_tf_records(args)
-            train_dataset, dev_dataset = prepare_datasets(train_dataset, dev_dataset, args)
-        
-        count_train, count_dev = 0, 0
-        for sents, seg in train_dataset:
-            count_train += 1
-        for sents, seg in dev_dataset:
-            count_dev += 1
-        tf.compat.v1.logging.info('train samples: {} dev samples: {}'.format(count_train, count_dev))
-
-        for sents, seg in train_dataset.take(1):
-            tf.compat.v1.logging.info('input shapes: {} {}'.format(sents.shape, seg.shape))
-            tf.compat.v1.logging.info('source: {} \n target: {} \n seg: {}\n'.format(sents[0][0], sents[0][1], seg[0]))
-           
-        if args.use_tpu:
-           train_dataset = strategy.experimental_distribute_dataset(train_dataset)
-           dev_dataset = strategy.experimental_distribute_dataset(dev_dataset)
-
-        transformer, optimizer = get_model_gec()
+                train_dataset, dev_dataset, = get_ids_dataset_tf_records(args, epoch)
+            if strategy is not None and not args.use_tpu:
+                # each worker batches its shard for its replicas
+                prepare_fn = lambda train, dev, replicas: prepare_datasets(train, dev, args, replicas, epoch)
+                return distribute_datasets(strategy, train_dataset, dev_dataset,
+                                           prepare_fn, args.batch_size, get_rows())
+            train_dataset, dev_dataset = prepare_datasets(train_dataset, dev_dataset, args, epoch=epoch)
+            train_dataset = train_dataset.skip(skip_batches)
+            if args.use_tpu:
+                return [strategy.experimental_distribute_dataset(dataset) for dataset in (train_dataset, dev_dataset)]
+            return train_dataset, dev_dataset
+
+        # the skipped batches are read again without training, the train metrics of the epoch
+        # start at the restart. distributed datasets skip them in the loop below
+        skip_batches = 0 if args.save_iterator or strategy is not None else start_batch
+        train_dataset, dev_dataset = build_datasets(start_epoch, skip_batches)
+
+        datasets_info = get_datasets_info(args)
+        for split, info in datasets_info.items():
+            tf.compat.v1.logging.info('{} rows: {} examples: {} source tokens: {} target tokens: {}'.format(
+                split, info['rows'], info.get('examples'), info.get('source_tokens'), info.get('target_tokens')))
+        if args.distribution == 'multi_worker' and None in get_rows():
+            tf.compat.v1.logging.warning('nr of rows unknown (packed rows or no manifest), '
+                                         'workers may run a different nr of batches and block')
+
+        if strategy is None:
+            for batch in train_dataset.take(1):
+                sents, seg = batch[:2]
+                tf.compat.v1.logging.info('input shapes: {} {}'.format(sents.shape, seg.shape))
+                tf.compat.v1.logging.info('source: {} \n target: {} \n seg: {}\n'.format(sents[0][0], sents[0][1], seg[0]))
+
+        # the steps are fed the cached encoder outputs
+        transformer, optimizer = get_model_gec(cached_encoder=args.bert_cache)
+        if args.recompute_grad:
+            # recomputed layers can not create their variables in the train step
+            build_model(transformer, args.bert)
+        state = {'epoch': epoch_var, 'batch': batch_var}
+        iterator = iter(train_dataset)
+        if args.save_iterator:
+            state['iterator'] = iterator
         # object you want to checkpoint are saved as attributes of the checkpoint obj
-        if args.bert:
-            ckpt = tf.train.Checkpoint(decoder=transformer.decoder, 
-                                        final_layer=transformer.final_layer, optimizer=optimizer)
-        else:
-            ckpt = tf.train.Checkpoint(transformer=transformer, optimizer=optimizer)
+        ckpt = get_checkpoint(transformer, optimizer, **state)
        
-        ckpt_manager = tf.train.CheckpointManager(ckpt, args.checkpoint_path, max_to_keep=5)
-        if ckpt_manager.latest_checkpoint:
+        # every worker saves (the save is synchronized), only the chief to checkpoint_path
+        checkpointer = AsyncCheckpointer(ckpt, get_worker_path(args.checkpoint_path), max_to_keep=5)
+        if latest_checkpoint:
             # loading mechanis matches variables from the tf graph and resotres their values
-            ckpt.restore(ckpt_manager.latest_checkpoint)
+            restore_checkpoint(ckpt, latest_checkpoint, transformer)
             tf.compat.v1.logging.info('latest checkpoint restored {}'.format(args.checkpoint_path))
 
         if args.reset_opt:
@@ -505,60 +584,145 @@ def train_gec():
                                         epsilon=1e-9)
 
         tf.compat.v1.logging.info('lr after reset: {}'.format(optimizer._decayed_lr(tf.float32)))
+
+        # built once the model and the (possibly reset) optimizer exist
+        train_step_fn = get_train_step_fn(transformer, optimizer, train_metrics, bert=args.bert, pack=args.pack,
+                                          distributed=strategy is not None)
+        eval_step_fn = get_eval_step_fn(transformer, eval_metrics, bert=args.bert, pack=args.pack)
+        train_step = TracedFunction(train_step_fn, 'train_step', train_step_signature, args.jit_compile)
+        eval_step = TracedFunction(eval_step_fn, 'eval_step', eval_step_signature, args.jit_compile)
+
+        @tf.function
+        def train_steps(iterator, steps):
+            """runs up to steps train steps in one call, returns how many were run
+            (fewer at the end of the epoch)"""
+            count = tf.constant(0)
+            for _ in tf.range(steps):
+                batch = tf.data.experimental.get_next_as_optional(iterator)
+                if not batch.has_value():
+                    break
+                train_step_fn(*batch.get_value())
+                count += 1
+            return count
+
+        # loss and accuracy are accumulated by the metrics (summed over the replicas), not returned
+        @tf.function
+        def distributed_train_step(dataset_inputs):
+            run_on_replicas(strategy, train_step_fn, dataset_inputs)
+
+        @tf.function
+        def distributed_eval_step(dataset_inputs):
+            run_on_replicas(strategy, eval_step_fn, dataset_inputs)
+
         tf.compat.v1.logging.info('starting training...')
-        eval_losses, train_losses, eval_accuracies, train_accuracies = [], [], [], []
 
-        for epoch in range(args.epochs):
+        def log_train_metrics(epoch, batch_idx):
+            result = train_metrics.result()
+            print_stats(args, epoch=epoch, stage='train', batch_idx=batch_idx,
+                        loss=result['loss'], acc=result['accuracy'], log=log)
+            write_metrics(metrics_log, epoch, 'train', batch_idx, result)
+
+        def save_checkpoint(epoch, batches):
+            epoch_var.assign(epoch)
+            batch_var.assign(batches)
+            ckpt_save_path = checkpointer.save()
+            message = 'Saving checkpoint at {}, resumes epoch {} after {} batches \n'.format(ckpt_save_path,
+                                                                    epoch+1, batches)
+            log.write(message)
+            log.flush()
+            tf.compat.v1.logging.info(message)
+
+        def crossed(batches, steps, every):
+            """true if a multiple of every is in (batches, batches + steps]"""
+            return every > 0 and (batches + steps) // every > batches // every
+
+        if start_epoch or start_batch:
+            tf.compat.v1.logging.info('resuming epoch {} after {} batches'.format(start_epoch + 1, start_batch))
+        if start_batch and not args.save_iterator and strategy is not None:
+            # read without training, the train metrics of the epoch start at the restart
+            for _ in range(start_batch):
+                next(iterator)
+
+        profiler.reset()
+        for epoch in range(start_epoch, args.epochs):
             # train 
-            for batch_idx, data in enumerate(train_dataset):
-                
-                if args.use_tpu:
-                    mean_loss, mean_acc = distributed_train_step(data)
-                else:
-                    data, inp_seg = data
-                    mean_loss, mean_acc = train_step(data, inp_seg)
-                train_losses.append(mean_loss)
-                train_accuracies.append(mean_acc)
-
-            train_loss = tf.reduce_mean(train_losses).numpy()
-            train_accuracy = tf.reduce_mean(train_accuracies).numpy()
+            train_metrics.reset()
+            batches = start_batch if epoch == start_epoch else 0
+            if args.steps_per_call > 1 and strategy is None:
+                while True:
+                    # the data wait is part of the compiled steps
+                    with profiler.phase('train_steps'):
+                        steps = int(train_steps(iterator, tf.constant(args.steps_per_call)))
+                    if crossed(batches, steps, args.log_every):
+                        log_train_metrics(epoch, batches + steps - 1)
+                    if crossed(batches, steps, args.checkpoint_steps) and steps == args.steps_per_call:
+                        save_checkpoint(epoch, batches + steps)
+                    batches += steps
+                    if steps < args.steps_per_call:
+                        break
+            else:
+                for batch_idx, data in enumerate(profiler.timed(iterator, 'data'), start=batches):
+                    profiler.step(batch_idx)
+                    with profiler.phase('train_step'):
+                        if strategy is not None:
+                            distributed_train_step(data)
+                        else:
+                            profiler.sync(train_step(*data))
+
+                    if args.log_every and (batch_idx + 1) % args.log_every == 0:
+                        with profiler.phase('log'):
+                            log_train_metrics(epoch, batch_idx)
+                    if args.checkpoint_steps and (batch_idx + 1) % args.checkpoint_steps == 0:
+                        with profiler.phase('checkpoint'):
+                            save_checkpoint(epoch, batch_idx + 1)
+                    batches = batch_idx + 1
+
+            result = train_metrics.result()
+            profiler.count(tokens=result['tokens'], batches=batches - (start_batch if epoch == start_epoch else 0))
+            profiler.log_report('train', get_worker_path(args.profile_report), epoch=epoch + 1)
+            profiler.reset()
             print_stats(args, epoch=epoch, stage='train', batch_idx=None, 
-                             loss=train_loss, acc=train_accuracy, log=log)
-
+                             loss=result['loss'], acc=result['accuracy'], log=log)
+            write_metrics(metrics_log, epoch, 'train', None, result)
+
+            # the iterator of the next epoch is the one saved at the end of this epoch, its
+            # order only depends on shuffle_seed and the epoch
+            train_dataset, _ = build_datasets(epoch + 1)
+            iterator = iter(train_dataset)
+            if args.save_iterator:
+                ckpt.iterator = iterator
             if (epoch + 1) % 2 == 0:
-                ckpt_save_path = ckpt_manager.save()
-                log.write('Saving checkpoint for epoch {} at {} \n'.format(epoch+1,
-                                                                    ckpt_save_path))
-                log.flush()
-                tf.compat.v1.logging.info('Saving checkpoint for epoch {} at {} \n'.format(epoch+1,
-                                                                    ckpt_save_path))
+                save_checkpoint(epoch + 1, 0)
             # eval
-            for batch_idx, data in enumerate(dev_dataset):
-                
-                if args.use_tpu:
-                    mean_loss, mean_acc = distributed_eval_step(data)
-                else:
-                    data, inp_seg = data
-                    mean_loss, mean_acc = eval_step(data, inp_seg)
-                eval_losses.append(mean_loss)
-                eval_accuracies.append(mean_acc)
-
-            eval_loss = tf.reduce_mean(eval_losses).numpy()
-            eval_accuracy = tf.reduce_mean(eval_accuracies).numpy()
+            eval_metrics.reset()
+            dev_batches = 0
+            for data in profiler.timed(dev_dataset, 'data'):
+                with profiler.phase('eval_step'):
+                    if strategy is not None:
+                        distributed_eval_step(data)
+                    else:
+                        profiler.sync(eval_step(*data))
+                dev_batches += 1
+
+            result = eval_metrics.result()
+            profiler.count(tokens=result['tokens'], batches=dev_batches)
+            profiler.log_report('dev', get_worker_path(args.profile_report), epoch=epoch + 1)
+            profiler.reset()
             print_stats(args, epoch=epoch, stage='dev', batch_idx=None, 
-                             loss=eval_loss, acc=eval_accuracy, log=log)
+                             loss=result['loss'], acc=result['accuracy'], log=log)
+            write_metrics(metrics_log, epoch, 'dev', None, result)
 
             tf.compat.v1.logging.info('lr : {}'.format(optimizer._decayed_lr(tf.float32)))
 
+        checkpointer.close()
+
 def run_main():
     if args.records:
         construct_tf_records(args, args.subwords_path)
 
-        train_tf_records = os.path.join(args.tf_records, 'train.tfrecord')
-        dev_tf_records = os.path.join(args.tf_records, 'dev.tfrecord')
         tokeinizer_ro_tf_records = os.path.join(args.tf_records, 'tokenizer_ro.subwords')
-
-        files_to_transfer = [train_tf_records, dev_tf_records, tokeinizer_ro_tf_records]
+        manifest = read_manifest(args.tf_records)
+        files_to_transfer = get_manifest_files(manifest, args.tf_records) + [tokeinizer_ro_tf_records]
 
         for file_path in files_to_transfer:
             upload_blob(args.bucket, file_path, file_path)
@@ -569,21 +733,16 @@ def run_main():
 
     if args.train_mode:
         train_gec()
+    if args.export_inference:
+        export_inference_checkpoint()
     if args.decode_mode:
         correct_from_file(in_file=args.in_file_decode, out_file=args.out_file_decode)
     
 def main(argv):
     del argv
     global args, strategy
-    if args.use_tpu == True:
-        tpu_cluster_resolver = tf.distribute.cluster_resolver.TPUClusterResolver(args.tpu,
-             zone=args.tpu_zone, project=args.gcp_project)
-        tf.config.experimental_connect_to_cluster(tpu_cluster_resolver)
-        tf.tpu.experimental.initialize_tpu_system(tpu_cluster_resolver)
-        strategy = tf.distribute.experimental.TPUStrategy(tpu_cluster_resolver)
-        # strategy.experimental_enable_dynamic_batch_size = False
-        tf.compat.v1.logging.info('Running on TPU {}'.format(tpu_cluster_resolver.cluster_spec().as_dict()['worker']))
-        tf.compat.v1.logging.info("Tpu replicas in sync: {}".format(strategy.num_replicas_in_sync))
+    strategy = get_strategy(args)
+    if strategy is not None:
         with strategy.scope():
             run_main()
     else:
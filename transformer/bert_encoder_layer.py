@@ -1,6 +1,8 @@
 import tensorflow as tf
 import bert
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 class BertEncoder(tf.keras.layers.Layer):
     def __init__(self, model_dir, d_model, args):
@@ -10,13 +12,32 @@ class BertEncoder(tf.keras.layers.Layer):
         self.model_dir = model_dir
         tf.compat.v1.logging.info('bert model loaded from {}'.format(model_dir))
         tf.compat.v1.logging.info('bert model params: {}'.format(bert_params))
-        # do dummy call to build the model indirectly 
-        self.bert_layer([tf.zeros([args.batch_size, args.seq_length], dtype=tf.dtypes.int64),
-             tf.zeros([args.batch_size, args.seq_length], dtype=tf.dtypes.int64)])
+        # symbolic call on keras inputs, creates the variables without running the model
+        self.bert_layer([tf.keras.layers.Input(shape=(args.seq_length, ), dtype=tf.dtypes.int64),
+             tf.keras.layers.Input(shape=(args.seq_length, ), dtype=tf.dtypes.int64)])
+        self.weights_future = None
+        if tf.distribute.has_strategy():
+            # the strategy scope is not visible from another thread
+            self.load_weights()
+        else:
+            # read while the rest of the model is constructed, awaited by the first call
+            executor = ThreadPoolExecutor(max_workers=1)
+            self.weights_future = executor.submit(self.load_weights)
+            executor.shutdown(wait=False)
+
+    def load_weights(self):
+        start = time.time()
         bert.load_bert_weights(self.bert_layer, os.path.join(self.model_dir, "bert_model.ckpt"))
-        tf.compat.v1.logging.info('bert weights loaded')
-        
+        tf.compat.v1.logging.info('bert weights loaded in {:.2f}s'.format(time.time() - start))
+
+    def wait_weights(self):
+        """blocks until the weights are loaded, raises the loading error"""
+        if self.weights_future is not None:
+            self.weights_future.result()
+            self.weights_future = None
+
     def call(self, input_ids, segment_ids, training):
+        self.wait_weights()
         bert_output = self.bert_layer([input_ids, segment_ids])
-        
+
         return bert_output  # (batch_size, input_seq_len, d_model)
\ No newline at end of file
@@ -0,0 +1,116 @@
+import io
+import json
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+
+INFERENCE_WEIGHTS = 'weights.npz'
+INFERENCE_MANIFEST = 'manifest.json'
+
+
+def copy_checkpoint(prefix: str, directory: str):
+    """copies the index and data files of a checkpoint, returns its prefix in directory"""
+    for path in tf.io.gfile.glob(prefix + '.*'):
+        tf.io.gfile.copy(path, os.path.join(directory, os.path.basename(path)), overwrite=True)
+    return os.path.join(directory, os.path.basename(prefix))
+
+def delete_checkpoint(prefix: str):
+    for path in tf.io.gfile.glob(prefix + '.*'):
+        tf.io.gfile.remove(path)
+
+class AsyncCheckpointer(object):
+    """checkpoints written without stalling the training on a slow directory (gs://).
+    save() writes the checkpoint to a local staging dir on the train thread, a snapshot of
+    the variables, then a background thread copies it to directory. the checkpoint state
+    file of directory is updated last, a copy interrupted by a preemption leaves the
+    previous checkpoint as the latest one. at most one copy is pending, a save waits
+    for the previous copy"""
+
+    def __init__(self, checkpoint, directory: str, max_to_keep: int = 5):
+        self.directory = directory
+        self.max_to_keep = max_to_keep
+        tf.io.gfile.makedirs(directory)
+        staging_dir = tempfile.mkdtemp(prefix='checkpoint_staging_')
+        # the previous staged checkpoint is deleted once its copy is done
+        self.staging = tf.train.CheckpointManager(checkpoint, staging_dir, max_to_keep=1)
+        state = tf.train.get_checkpoint_state(directory)
+        self.checkpoints = list(state.all_model_checkpoint_paths) if state else []
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def save(self):
+        """returns the prefix the checkpoint will have in directory"""
+        self.wait()
+        prefix = self.staging.save()
+        self.pending = self.executor.submit(self._copy, prefix)
+        return os.path.join(self.directory, os.path.basename(prefix))
+
+    def _copy(self, prefix):
+        self.checkpoints.append(copy_checkpoint(prefix, self.directory))
+        tf.compat.v1.train.update_checkpoint_state(self.directory, self.checkpoints[-1],
+                                                   all_model_checkpoint_paths=self.checkpoints[-self.max_to_keep:])
+        for old_prefix in self.checkpoints[:-self.max_to_keep]:
+            delete_checkpoint(old_prefix)
+        self.checkpoints = self.checkpoints[-self.max_to_keep:]
+
+    def wait(self):
+        """blocks until the pending copy is done, raises its error"""
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+def write_inference_checkpoint(variables, path: str, fp16: bool = False, config=None, files=()):
+    """weights only checkpoint for decoding, without the optimizer slots (adam keeps two per
+    weight). the variables are stored in order, float32 ones as float16 with fp16. files
+    (tokenizers) are copied next to the weights. returns the manifest"""
+    tf.io.gfile.makedirs(path)
+    arrays, entries = {}, []
+    for i, variable in enumerate(variables):
+        value = variable.numpy()
+        if fp16 and value.dtype == np.float32:
+            value = value.astype(np.float16)
+        arrays['w{}'.format(i)] = value
+        entries.append({'name': variable.name, 'shape': list(value.shape), 'dtype': str(value.dtype)})
+
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    with tf.io.gfile.GFile(os.path.join(path, INFERENCE_WEIGHTS), 'wb') as fout:
+        fout.write(buffer.getvalue())
+
+    for file_path in files:
+        tf.io.gfile.copy(file_path, os.path.join(path, os.path.basename(file_path)), overwrite=True)
+
+    manifest = {'variables': entries, 'fp16': fp16, 'config': config or {},
+                'files': [os.path.basename(file_path) for file_path in files],
+                'bytes': len(buffer.getvalue())}
+    with tf.io.gfile.GFile(os.path.join(path, INFERENCE_MANIFEST), 'w') as fout:
+        json.dump(manifest, fout, indent=2)
+    return manifest
+
+def read_inference_manifest(path: str):
+    with tf.io.gfile.GFile(os.path.join(path, INFERENCE_MANIFEST), 'r') as fin:
+        return json.load(fin)
+
+def load_inference_checkpoint(variables, path: str):
+    """assigns the weights of write_inference_checkpoint to the variables of a model built
+    the same way (same order), fp16 weights are cast back. returns the manifest"""
+    manifest = read_inference_manifest(path)
+    entries = manifest['variables']
+    if len(entries) != len(variables):
+        raise ValueError('inference checkpoint {} has {} variables, the model {}'.format(
+            path, len(entries), len(variables)))
+    with tf.io.gfile.GFile(os.path.join(path, INFERENCE_WEIGHTS), 'rb') as fin:
+        weights = np.load(io.BytesIO(fin.read()))
+    for i, (variable, entry) in enumerate(zip(variables, entries)):
+        if list(variable.shape) != entry['shape']:
+            raise ValueError('variable {} has shape {}, {} in the inference checkpoint'.format(
+                variable.name, list(variable.shape), entry['shape']))
+        variable.assign(weights['w{}'.format(i)].astype(variable.dtype.as_numpy_dtype))
+    return manifest
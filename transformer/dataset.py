@@ -1,89 +1,192 @@
 import tensorflow as tf
+import argparse
 import os
+import multiprocessing
+import collections
+import hashlib
+import itertools
+import json
 from os.path import join
 from shutil import copyfile
 from bert.tokenization.bert_tokenization import FullTokenizer
-import tensorflow_datasets as tfds
+from transformer.subword_tokenizer import FastSubwordTextEncoder
 from typing import Dict, List, Tuple
 import numpy as np
-from transformer.utils import create_masks
+from transformer.utils import create_masks, get_epoch_seed
+from transformer.bert_encoder_layer import BertEncoder
 from transformer.serialization import example_encode_text_dataset, get_text_dataset_tf_records
-from transformer.serialization import serialize_ids_dataset
+from transformer.serialization import serialize_example_row, get_shard_name,\
+    write_manifest, read_manifest, get_length_stats, merge_length_stats, RECORD_DTYPES, RECORD_COMPRESSIONS,\
+    MANIFEST_FILE
+from transformer.token_store import TokenStore, write_token_store, read_token_store_meta
+from transformer.encoder_cache import EncoderCache, write_encoder_cache, read_encoder_cache_meta
 
 args, tokenizer_ro, tokenizer_bert = None, None, None
+# bert encoder of the encoder caches, built by the first cache computed
+cache_encode_fn = None
+
+# consecutive pairs tokenized by one task
+ENCODE_CHUNK = 1024
+# chunks read ahead for each encoding process
+ENCODE_PENDING = 4
+# growth of the token batching buckets with jit_compile
+JIT_BUCKET_STEP = 1.5
+# dir of the bert encoder outputs in the token store
+ENCODER_CACHE_DIR = 'bert_encoder'
+# options read by prepare_datasets and batch_by_tokens for the dev batches, and the ones
+# choosing their content. with get_encoder_options they key the dev cache file
+DEV_BATCH_OPTIONS = ('batch_size', 'max_tokens', 'seq_length', 'jit_compile', 'pack', 'bert', 'bert_cache')
 
 train_step_signature_np = [tf.TensorSpec(shape=(None, None, None), dtype=tf.int64),
     tf.TensorSpec(shape=(None, None), dtype=tf.int64)]
 
 
-def construct_flat_datasets(args1, subwords_path):
-    global tokenizer_bert, tokenizer_ro, args
+def load_tokenizers(args, subwords_path):
+    global tokenizer_bert, tokenizer_ro
 
-    args = args1
     if args.bert:
         tokenizer_bert = FullTokenizer(vocab_file=join(args.bert_model_dir, "vocab.vocab"))
         tokenizer_bert.vocab_size = len(tokenizer_bert.vocab)
 
-    samples = get_text_samples(args)
-
     if os.path.isfile(subwords_path + '.subwords'): 
         tokenizer_ro  = construct_tokenizer(None, subwords_path, args)
     else:
-        tokenizer_ro = construct_tokenizer(list(samples), subwords_path, args)
+        tokenizer_ro = construct_tokenizer([args.dataset_file], subwords_path, args)
+    return tokenizer_ro, tokenizer_bert
 
-    sample_train = int(args.total_samples * args.train_dev_split)
-
-    if args.records:
-
-        dataset = tf.data.Dataset.from_generator(generator_tensors_ids_and_segs,
-                                        ((tf.int64, tf.int64), tf.int64), 
-                                        ((tf.TensorShape([None]), tf.TensorShape([None])), tf.TensorShape([None])))
-        if args.separate:
-            train_dataset = dataset
-            dev_dataset = tf.data.Dataset.from_generator(generator_tensors_ids_and_segs_dev,
-                                        ((tf.int64, tf.int64), tf.int64), 
-                                        ((tf.TensorShape([None]), tf.TensorShape([None])), tf.TensorShape([None])))
-            return train_dataset, dev_dataset
-    else:
-        gen_dataset = generator_tensors_ids()
-        dataset = list(gen_dataset)
-        nr_samples = len(dataset)
-        sample_train = int(args.train_dev_split * nr_samples)
-        # dataset = tf.convert_to_tensor(dataset, dtype=tf.int64)
-        dataset = tf.data.Dataset.from_generator(generator_tensors_ids,
-                                        (tf.int64, tf.int64), 
-                                        (tf.TensorShape([2, args.seq_length]), tf.TensorShape([args.seq_length])))
-        if args.separate:
-            gen_dataset = generator_tensors_ids_dev()
-            dev_dataset = list(gen_dataset)
-            # dataset = tf.convert_to_tensor(dataset, dtype=tf.int64)
-            dev_dataset = tf.data.Dataset.from_generator(generator_tensors_ids_dev,
-                                            (tf.int64, tf.int64), 
-                                            (tf.TensorShape([2, args.seq_length]), tf.TensorShape([args.seq_length])))
-            return dataset, dev_dataset  
-                              
-    train_dataset = dataset.take(sample_train)
-    dev_dataset = dataset.skip(sample_train)
+def construct_flat_datasets(args1, subwords_path, epoch=0):
+    """train and dev datasets of the token stores, the train order is the one of epoch"""
+    global tokenizer_bert, tokenizer_ro, args
 
+    args = args1
+    if tokenizer_ro is None:
+        load_tokenizers(args, subwords_path)
+    seed = get_epoch_seed(args.shuffle_seed, epoch)
+
+    store = load_token_store(args.dataset_file, args)
+    features = load_encoder_cache(args.dataset_file, store, args)
+    if args.separate:
+        train_dataset = store.get_dataset(shuffle=True, seed=seed, features=features)
+        dev_store = load_token_store(args.dataset_file_dev, args)
+        dev_dataset = dev_store.get_dataset(features=load_encoder_cache(args.dataset_file_dev, dev_store, args))
+        return train_dataset, dev_dataset
+    # split before shuffling, dev rows never end up in train
+    sample_train = int(args.train_dev_split * len(store))
+    train_dataset = store.get_dataset(0, sample_train, shuffle=True, seed=seed, features=features)
+    dev_dataset = store.get_dataset(sample_train, features=features)
     return train_dataset, dev_dataset
 
-def construct_datasets_gec(args, subwords_path):
-    
-    train_dataset, dev_dataset = construct_flat_datasets(args, subwords_path)
-    return prepare_datasets(train_dataset, dev_dataset, args)
-   
-def prepare_datasets(train_dataset, dev_dataset, args):
-    train_dataset = train_dataset.shuffle(args.buffer_size).batch(args.batch_size, drop_remainder=True)
+def prepare_datasets(train_dataset, dev_dataset, args, replicas=1, epoch=0):
+    """batches of args.batch_size examples (args.max_tokens tokens) split between the replicas,
+    the train batches are shuffled in the order of epoch"""
+    seed = get_epoch_seed(args.shuffle_seed, epoch)
+    if args.max_tokens:
+        max_tokens = args.max_tokens // replicas
+        train_dataset = batch_by_tokens(train_dataset.shuffle(args.buffer_size, seed=seed,
+                                                              reshuffle_each_iteration=True), args, max_tokens)
+        train_dataset = train_dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+        dev_dataset = batch_by_tokens(dev_dataset, args, max_tokens)
+        return train_dataset, cache_dev_dataset(dev_dataset, args, replicas)
+
+    batch_size = args.batch_size // replicas
+    train_dataset = train_dataset.shuffle(args.buffer_size, seed=seed, reshuffle_each_iteration=True)
+    train_dataset = train_dataset.batch(batch_size, drop_remainder=True)
     train_dataset = train_dataset.prefetch(tf.data.experimental.AUTOTUNE) # how many batches to prefectch
 
-    dev_dataset = dev_dataset.shuffle(args.buffer_size).batch(args.batch_size, drop_remainder=True)
-    return train_dataset, dev_dataset
+    dev_dataset = dev_dataset.batch(batch_size, drop_remainder=True)
+    return train_dataset, cache_dev_dataset(dev_dataset, args, replicas)
+
+def cache_dev_dataset(dev_dataset, args, replicas=1):
+    """the dev set is evaluated in the same order each epoch, its batches are read (and tokenized)
+    once and then served from memory or from the args.dev_cache file"""
+    return dev_dataset.cache(get_dev_cache_path(args, replicas)).prefetch(tf.data.experimental.AUTOTUNE)
+
+def get_dev_cache_path(args, replicas=1):
+    """args.dev_cache suffixed by a hash of the batching options and of the dev data files, the
+    batches of other options or data are cached in another file. empty for a cache in memory"""
+    if not args.dev_cache:
+        return ''
+    if args.use_txt:
+        files = [args.dataset_file_dev if args.separate else args.dataset_file, args.subwords_path + '.subwords']
+    else:
+        path_tf_records = join('gs://', args.bucket, args.tf_records) if args.use_tpu else args.tf_records
+        files = [join(path_tf_records, MANIFEST_FILE)]
+        if not tf.io.gfile.exists(files[0]):
+            files = [join(path_tf_records, 'dev.tfrecord')]
+    key = {name: getattr(args, name) for name in DEV_BATCH_OPTIONS}
+    key.update(replicas=replicas, train_dev_split=None if args.separate else args.train_dev_split,
+               data=[get_file_identity(path) for path in files])
+    if args.bert_cache:
+        key['encoder'] = get_encoder_options(args)
+    digest = hashlib.md5(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+    path = '{}.{}'.format(args.dev_cache, digest)
+    tf.compat.v1.logging.info('dev batches cached in {}'.format(path))
+    return path
+
+def get_bucket_boundaries(max_length, min_length=8, length_bucket_step=1.1):
+    """geometric length boundaries, bucket i holds lengths in [boundaries[i-1], boundaries[i])"""
+    boundaries = []
+    length = min_length
+    while length < max_length:
+        boundaries.append(length)
+        length = max(length + 1, int(length * length_bucket_step))
+    return boundaries
+
+def get_example_length(data, segs):
+    """length of the longest sentence (source or target) of an example, padding excluded"""
+    return tf.cast(tf.reduce_max(tf.math.count_nonzero(data, axis=-1)), tf.int32)
+
+def trim_batch_padding(data, segs):
+    """cut the padding columns shared by all examples of the batch"""
+    max_length = tf.reduce_max(tf.math.count_nonzero(data, axis=-1))
+    return data[..., :max_length], segs[..., :max_length]
+
+def batch_by_tokens(dataset, args, max_tokens=None):
+    """batches examples of similar length so that a batch holds at most args.max_tokens
+    tokens (source + target). the shuffled input acts as a pool that is split in length
+    buckets, each bucket emits its batch when full and its partial batch at the end
+    of the dataset, so no example is dropped. the options read here are DEV_BATCH_OPTIONS"""
+    # coarser buckets when compiling, each bucket length is a compilation
+    boundaries = get_bucket_boundaries(args.seq_length,
+                                       length_bucket_step=JIT_BUCKET_STEP if args.jit_compile else 1.1)
+    buckets_min = [0] + boundaries
+    buckets_max = boundaries + [args.seq_length + 1]
+    # longest example of a bucket is bucket_max - 1, both source and target count
+    max_tokens = max_tokens or args.max_tokens
+    batch_sizes = [max(1, max_tokens // (2 * (length - 1))) for length in buckets_max]
+
+    def key_func(data, segs):
+        length = get_example_length(data, segs)
+        in_bucket = tf.logical_and(tf.less_equal(buckets_min, length), tf.less(length, buckets_max))
+        return tf.cast(tf.reduce_min(tf.where(in_bucket)), tf.int64)
+
+    def window_size_func(bucket_id):
+        return tf.constant(batch_sizes, dtype=tf.int64)[bucket_id]
+
+    def reduce_func(bucket_id, window):
+        batches = window.batch(window_size_func(bucket_id))
+        if args.jit_compile:
+            # one length per bucket instead of the longest example of each batch, xla
+            # compiles the steps once per shape
+            length = tf.constant(buckets_max, dtype=tf.int64)[bucket_id] - 1
+            return batches.map(lambda data, segs: (data[..., :length], segs[..., :length]))
+        return batches
+
+    dataset = dataset.apply(tf.data.experimental.group_by_window(key_func, reduce_func,
+                                                    window_size_func=window_size_func))
+    if args.jit_compile:
+        return dataset
+    return dataset.map(trim_batch_padding, num_parallel_calls=tf.data.experimental.AUTOTUNE)
 
 def construct_tf_records(args1, subwords_path=None):
-    """given a txt constructs tf records files + subwords dictionary"""
-    global tokenizer_bert, tokenizer_ro
+    """given a txt constructs sharded tf records files + subwords dictionary + manifest.
+    the shards are tokenized and written in parallel, one process per shard"""
+    global tokenizer_bert, tokenizer_ro, args
+    args = args1
     tf.compat.v1.logging.info('constructing tf records files and vocabularies in {}'.format(args1.tf_records))
-    train_dataset, dev_dataset = construct_flat_datasets(args1, subwords_path)
+    load_tokenizers(args1, subwords_path)
+    check_record_options(args1)
 
     if not os.path.exists(args1.tf_records):
         os.makedirs(args1.tf_records)
@@ -95,10 +198,193 @@ def construct_tf_records(args1, subwords_path=None):
     if args1.bert:
         copyfile(vocab_file_source, tokenizer_bert_path)
     
-    # todo save bert tokenizer
-    serialize_ids_dataset(train_dataset, args1, 'train.tfrecord')
-    serialize_ids_dataset(dev_dataset, args1, 'dev.tfrecord')
-    tf.compat.v1.logging.info('tf records files and vocabularies constructed in {}'.format(args1.tf_records))
+    if args1.separate:
+        splits = {'train': (args1.dataset_file, 0, None), 'dev': (args1.dataset_file_dev, 0, None)}
+    else:
+        sample_train = int(args1.total_samples * args1.train_dev_split)
+        splits = {'train': (args1.dataset_file, 0, sample_train),
+                  'dev': (args1.dataset_file, sample_train, None)}
+
+    # each shard holds a contiguous part of the split, the reader interleaves the shards.
+    # a shard starts reading at the byte offset of its first pair
+    num_shards = args1.record_shards
+    tasks = []
+    for split, (dataset_file, first, last) in splits.items():
+        if last is None:
+            last = count_pairs(dataset_file)
+        size = max(0, last - first)
+        bounds = [first + size * shard // num_shards for shard in range(num_shards + 1)]
+        byte_offsets = get_pair_offsets(dataset_file, bounds)
+        tasks.extend((split, dataset_file, byte_offsets[bounds[shard]], bounds[shard + 1] - bounds[shard],
+                        shard, num_shards) for shard in range(num_shards))
+
+    with get_encoders_pool(get_num_workers(args1), tokenizer_ro, tokenizer_bert, args1) as pool:
+        results = pool.map(write_tf_records_shard, tasks)
+
+    manifest = {'format': 'int64' if args1.record_dtype == 'int64' else 'bytes',
+                'dtype': args1.record_dtype, 'compression': args1.record_compression,
+                'padded': args1.pad_records, 'seq_length': args1.seq_length, 'pack': args1.pack,
+                'bert': args1.bert, 'vocab': get_vocab_stats(args1), 'splits': {}}
+    for split in splits:
+        split_results = [result for task, result in zip(tasks, results) if task[0] == split]
+        split_counts = [count for count, _, _ in split_results]
+        manifest['splits'][split] = {
+            'files': [get_shard_name(split, shard, num_shards) for shard in range(num_shards)],
+            'counts': split_counts,
+            'total': sum(split_counts),
+            'skipped': sum(skipped for _, _, skipped in split_results),
+            'stats': merge_length_stats([stats for _, stats, _ in split_results])}
+    write_manifest(args1.tf_records, manifest)
+    tf.compat.v1.logging.info('tf records files and vocabularies constructed in {}, train {} dev {}'.format(
+        args1.tf_records, manifest['splits']['train']['total'], manifest['splits']['dev']['total']))
+
+def get_token_store_path(dataset_file, args):
+    if args.token_store:
+        return join(args.token_store, os.path.basename(dataset_file) + '.store')
+    return dataset_file + '.store'
+
+def get_file_identity(path):
+    """absolute path, size and mtime of a file (local or bucket), changes when the file is rewritten"""
+    stat = tf.io.gfile.stat(path)
+    return {'path': path if '://' in path else os.path.abspath(path), 'size': stat.length,
+            'mtime': stat.mtime_nsec}
+
+def get_token_store_info(dataset_file, args):
+    """what the tokenized store depends on, a store built differently is rebuilt. a vocabulary
+    rebuilt with the same size has other ids, the subwords file itself is compared"""
+    stat = os.stat(dataset_file)
+    info = {'dataset_file': os.path.abspath(dataset_file), 'size': stat.st_size, 'mtime': stat.st_mtime,
+            'vocab_size': tokenizer_ro.vocab_size, 'subwords': get_file_identity(args.subwords_path + '.subwords'),
+            'bert': args.bert, 'seq_length': args.seq_length}
+    if args.bert:
+        info['bert_vocab'] = get_file_identity(join(args.bert_model_dir, 'vocab.vocab'))
+    return info
+
+def is_token_store_valid(meta, info):
+    if meta is None:
+        return False
+    # the pairs longer than seq_length are skipped, a store of another seq_length has other pairs
+    return all(meta.get(key) == value for key, value in info.items())
+
+def load_token_store(dataset_file, args):
+    """memory mapped store of the tokenized dataset_file, tokenized only the first time"""
+    path = get_token_store_path(dataset_file, args)
+    info = get_token_store_info(dataset_file, args)
+    if not is_token_store_valid(read_token_store_meta(path), info):
+        tf.compat.v1.logging.info('tokenizing {} in {}'.format(dataset_file, path))
+        max_id = max(tokenizer_ro.vocab_size + 1, tokenizer_bert.vocab_size if args.bert else 0)
+        counts = collections.Counter()
+        write_token_store(path, generator_ids_unpadded(dataset_file, tokenizer_ro, tokenizer_bert, args, counts),
+                            max_id, info, counts=counts, pack_seq_length=args.seq_length if args.pack else 0)
+    return TokenStore(path, args.seq_length, pack=args.pack)
+
+def get_encoder_options(args):
+    """options of the cached encoder outputs (model, length and dtype)"""
+    return {'bert_model_dir': os.path.abspath(args.bert_model_dir), 'seq_length': args.seq_length,
+            'fp16': args.bert_cache_fp16}
+
+def get_encoder_cache_info(store, args):
+    """what the cached encoder outputs depend on, a cache built differently is rebuilt"""
+    return dict(get_encoder_options(args), store_tokens=store.meta['tokens'], store_examples=store.meta['examples'])
+
+def get_cache_encode_fn(args):
+    """encoder of the caches, the bert model is built and loaded once for all of them"""
+    global cache_encode_fn
+    if cache_encode_fn is None:
+        encoder = BertEncoder(model_dir=args.bert_model_dir, d_model=args.d_model, args=args)
+        cache_encode_fn = tf.function(lambda ids, segs: encoder(ids, segs, False),
+                                      input_signature=[tf.TensorSpec(shape=(None, None), dtype=tf.int64)] * 2)
+    return cache_encode_fn
+
+def load_encoder_cache(dataset_file, store, args):
+    """memory mapped outputs of the frozen bert encoder for the examples of the store, computed
+    only the first time. None without args.bert_cache"""
+    if not args.bert_cache:
+        return None
+    path = join(get_token_store_path(dataset_file, args), ENCODER_CACHE_DIR)
+    info = get_encoder_cache_info(store, args)
+    meta = read_encoder_cache_meta(path)
+    if meta is None or any(meta.get(key) != value for key, value in info.items()):
+        tf.compat.v1.logging.info('computing the bert encoder outputs of {} in {}'.format(dataset_file, path))
+        # the encoder is frozen, its outputs do not change during training
+        write_encoder_cache(path, store, get_cache_encode_fn(args), info, args.batch_size,
+                            fp16=args.bert_cache_fp16)
+    return EncoderCache(path, args.seq_length)
+
+def get_num_workers(args):
+    return args.num_workers if args.num_workers > 0 else multiprocessing.cpu_count()
+
+def write_tf_records_shard(task):
+    """tokenizes nr_pairs pairs of dataset_file from the byte offset start and writes them in
+    the shard: shard k of num_shards holds the k-th contiguous part of the pairs of its split.
+    returns the nr of rows, the length stats of the pairs and the nr of skipped pairs"""
+    split, dataset_file, start, nr_pairs, shard, num_shards = task
+    source_lengths, target_lengths = [], []
+    counts = collections.Counter()
+
+    def shard_examples():
+        pairs = gec_generator_range(dataset_file, start, nr_pairs)
+        for chunk in iter_chunks(pairs, ENCODE_CHUNK):
+            for source, target in skip_long_pairs(encode_chunk(chunk), counts):
+                source_lengths.append(len(source))
+                target_lengths.append(len(target))
+                yield source, target
+
+    if args.pack:
+        rows = pack_gec_examples(shard_examples(), args)
+    else:
+        rows = (pad_gec(source, target, args) for source, target in shard_examples())
+
+    count = 0
+    shard_path = join(args.tf_records, get_shard_name(split, shard, num_shards))
+    with tf.io.TFRecordWriter(shard_path, options=args.record_compression or None) as writer:
+        for (source, target), segments in rows:
+            writer.write(serialize_example_row(source, target, segments, dtype=args.record_dtype,
+                                                padded=args.pad_records))
+            count += 1
+    tf.compat.v1.logging.info('tf records shard {} written, {} rows, {} pairs longer than {} skipped'.format(
+        shard_path, count, counts['skipped'], args.seq_length))
+    return count, get_length_stats(source_lengths, target_lengths), counts['skipped']
+
+def check_record_options(args):
+    if args.record_compression not in RECORD_COMPRESSIONS:
+        raise ValueError('record_compression must be one of {}, got {}'.format(
+            RECORD_COMPRESSIONS, args.record_compression))
+    if args.record_dtype != 'int64' and args.record_dtype not in RECORD_DTYPES:
+        raise ValueError('record_dtype must be int64 or one of {}, got {}'.format(
+            list(RECORD_DTYPES), args.record_dtype))
+    if args.record_dtype == 'uint16':
+        max_id = max(tokenizer_ro.vocab_size + 1, tokenizer_bert.vocab_size if args.bert else 0, args.seq_length)
+        if max_id >= 2**16:
+            raise ValueError('ids up to {} do not fit in uint16, use int32'.format(max_id))
+
+def get_vocab_stats(args):
+    return {'vocab_size': tokenizer_ro.vocab_size, 'subwords': len(tokenizer_ro.subwords),
+            'bert_vocab_size': tokenizer_bert.vocab_size if args.bert else None}
+
+def get_datasets_info(args):
+    """rows, examples and length stats of the train and dev datasets, read from the token
+    store meta or the tf records manifest instead of iterating the datasets. empty for
+    tf records without manifest"""
+    if args.use_txt:
+        train_meta = read_token_store_meta(get_token_store_path(args.dataset_file, args))
+        rows = None if args.pack else train_meta['examples']
+        if args.separate:
+            dev_meta = read_token_store_meta(get_token_store_path(args.dataset_file_dev, args))
+            return {'train': dict(train_meta['stats'], rows=rows),
+                    'dev': dict(dev_meta['stats'], rows=None if args.pack else dev_meta['examples'])}
+        # the length stats are the ones of the whole file
+        sample_train = int(args.train_dev_split * train_meta['examples'])
+        return {'train': dict(train_meta['stats'], rows=rows and sample_train),
+                'dev': dict(train_meta['stats'], rows=rows and rows - sample_train)}
+
+    path_tf_records = args.tf_records
+    if args.use_tpu:
+        path_tf_records = join('gs://', args.bucket, path_tf_records)
+    manifest = read_manifest(path_tf_records)
+    if manifest is None:
+        return {}
+    return {split: dict(info.get('stats', {}), rows=info['total']) for split, info in manifest['splits'].items()}
 
 def test_map_numpy(tensor1, tensor2):
     global args
@@ -133,34 +419,106 @@ def construct_datatset_numpy(args1):
     #     print(x.shape)
     return train_dataset, val_dataset
 
-def generator_ids(tokenizer_ro, tokenizer_bert, args):
-
-    with open(args.dataset_file, 'r', encoding='utf-8', errors='replace') as f:
-        for i, line in enumerate(f):
-            if i % 2 == 0:
-                target = line.strip()
-            elif i % 2 == 1:
-                source = line.strip()
-                (source, target), segments = encode_gec(source, target, tokenizer_ro, tokenizer_bert, args)
-                if len(source) > args.seq_length or len(target) > args.seq_length:
-                    continue
-                yield (source, target), segments
-
-def generator_ids_dev(tokenizer_ro, tokenizer_bert, args):
-
-    with open(args.dataset_file_dev, 'r', encoding='utf-8', errors='replace') as f:
-        for i, line in enumerate(f):
-            if i % 2 == 0:
-                target = line.strip()
-            elif i % 2 == 1:
-                source = line.strip()
-                (source, target), segments = encode_gec(source, target, tokenizer_ro, tokenizer_bert, args)
-                if len(source) > args.seq_length or len(target) > args.seq_length:
-                    continue
-                yield (source, target), segments
-
-def gec_generator_text(args):
-    with open(args.dataset_file, 'r', encoding='utf-8', errors='replace') as f:
+def generator_ids_unpadded(dataset_file, tokenizer_ro, tokenizer_bert, args, counts=None):
+    """encoded pairs of dataset_file, counts['skipped'] counts the pairs longer than seq_length"""
+    counts = collections.Counter() if counts is None else counts
+    pairs = gec_generator_text(args, dataset_file)
+    yield from skip_long_pairs(encode_pairs_parallel(pairs, tokenizer_ro, tokenizer_bert, args), counts)
+    tf.compat.v1.logging.info('{}: {} pairs longer than {} skipped'.format(
+        dataset_file, counts['skipped'], args.seq_length))
+
+def skip_long_pairs(examples, counts):
+    """drops the pairs encode_gec_ids rejected (None), counted in counts['skipped']"""
+    for example in examples:
+        if example is None:
+            counts['skipped'] += 1
+            continue
+        yield example
+
+def iter_chunks(pairs, chunk_size):
+    chunk = list(itertools.islice(pairs, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(pairs, chunk_size))
+
+def set_encoders(tokenizer_ro1, tokenizer_bert1, args1):
+    global tokenizer_bert, tokenizer_ro, args
+    tokenizer_ro, tokenizer_bert, args = tokenizer_ro1, tokenizer_bert1, args1
+
+def get_encoders_pool(workers, tokenizer_ro, tokenizer_bert, args):
+    """pool of processes with the tokenizers and the args of this module (set_encoders). tensorflow
+    is already running here, a forked process would inherit the state of its threads, the workers
+    are spawned and the tokenizers and a plain copy of the options are sent to them once"""
+    values = args.flag_values_dict() if hasattr(args, 'flag_values_dict') else vars(args)
+    return multiprocessing.get_context('spawn').Pool(workers, initializer=set_encoders,
+        initargs=(tokenizer_ro, tokenizer_bert, argparse.Namespace(**values)))
+
+def encode_chunk(pairs):
+    return [encode_gec_ids(source, target, tokenizer_ro, tokenizer_bert, args) for source, target in pairs]
+
+def encode_pairs_parallel(pairs, tokenizer_ro, tokenizer_bert, args):
+    """encode_gec_ids of the (source, target) pairs, in order. chunks of ENCODE_CHUNK pairs
+    are encoded by a pool of processes, at most ENCODE_PENDING chunks per process are read
+    ahead of the consumer"""
+    workers = get_num_workers(args)
+    if workers == 1:
+        for source, target in pairs:
+            yield encode_gec_ids(source, target, tokenizer_ro, tokenizer_bert, args)
+        return
+
+    with get_encoders_pool(workers, tokenizer_ro, tokenizer_bert, args) as pool:
+        pending = collections.deque()
+        for chunk in iter_chunks(iter(pairs), ENCODE_CHUNK):
+            pending.append(pool.apply_async(encode_chunk, (chunk, )))
+            if len(pending) >= workers * ENCODE_PENDING:
+                yield from pending.popleft().get()
+        while pending:
+            yield from pending.popleft().get()
+
+def count_pairs(dataset_file):
+    """nr of (target, source) pairs of the file, without decoding it"""
+    lines, last = 0, b'\n'
+    with open(dataset_file, 'rb') as f:
+        for block in iter(lambda: f.read(2**24), b''):
+            lines += block.count(b'\n')
+            last = block[-1:]
+    if last != b'\n':
+        lines += 1
+    return lines // 2
+
+def get_pair_offsets(dataset_file, pairs):
+    """byte offsets where the pairs (indexes) start in the file, from one scan without decoding.
+    indexes past the last pair get the size of the file"""
+    wanted = sorted(set(pairs))
+    offsets, i, position = {}, 0, 0
+    with open(dataset_file, 'rb') as f:
+        for line_nr, line in enumerate(f):
+            if i == len(wanted):
+                break
+            if line_nr == 2 * wanted[i]:
+                offsets[wanted[i]] = position
+                i += 1
+            position += len(line)
+    for pair in wanted[i:]:
+        offsets[pair] = os.path.getsize(dataset_file)
+    return offsets
+
+def gec_generator_range(dataset_file, start, nr_pairs):
+    """(source, target) pairs as gec_generator_text, at most nr_pairs from the byte offset
+    start of a pair (get_pair_offsets)"""
+    with open(dataset_file, 'rb') as f:
+        f.seek(start)
+        for _ in range(nr_pairs):
+            target, source = f.readline(), f.readline()
+            if not source:
+                return
+            yield (source.decode('utf-8', errors='replace').strip(),
+                   target.decode('utf-8', errors='replace').strip())
+
+def gec_generator_text(args, dataset_file=None):
+    if dataset_file is None:
+        dataset_file = args.dataset_file
+    with open(dataset_file, 'r', encoding='utf-8', errors='replace') as f:
         for i, line in enumerate(f):
             if i % 2 == 0:
                 target = line.strip()
@@ -178,8 +536,9 @@ def make_fixed_length(input_ids: List[int], max_seq_len: int):
         input_ids = input_ids[:max_seq_len]
     return input_ids
 
-def encode_gec(source: str, target: str, tokenizer_ro, tokenizer_bert, args):
-
+def encode_gec_ids(source: str, target: str, tokenizer_ro, tokenizer_bert, args):
+    """ids of the source and target with start / end tokens, without padding. None if
+    one of them is longer than args.seq_length, such pairs are skipped"""
     if args.bert:
         tokens = ['[CLS]']
         tokens.extend(tokenizer_bert.tokenize(source))
@@ -191,6 +550,12 @@ def encode_gec(source: str, target: str, tokenizer_ro, tokenizer_bert, args):
     target = [tokenizer_ro.vocab_size] + tokenizer_ro.encode(target) +\
             [tokenizer_ro.vocab_size + 1]
 
+    if len(source) > args.seq_length or len(target) > args.seq_length:
+        return None
+    return source, target
+
+def pad_gec(source: List[int], target: List[int], args):
+
     segments = [0] * len(source) + [1] * (args.seq_length - len(source))
     source = make_fixed_length(source, args.seq_length)
     target = make_fixed_length(target, args.seq_length)
@@ -198,69 +563,50 @@ def encode_gec(source: str, target: str, tokenizer_ro, tokenizer_bert, args):
 
     return (source, target), segments
 
-def generator_tensors_ids():
-    global tokenizer_bert, tokenizer_ro, args
-    gen = generator_ids(tokenizer_ro, tokenizer_bert, args)
-    for step, ((s, t), segs) in enumerate(gen):
-        if step % 10000 == 0:
-            tf.compat.v1.logging.info('tf record generation, step {}'.format(step))
-        s = tf.convert_to_tensor(s, dtype=tf.int64)
-        t = tf.convert_to_tensor(t, dtype=tf.int64)
-        segs = tf.convert_to_tensor(segs, dtype=tf.int64)
-        # print(s.shape, t.shape, segs.shape, tf.stack([s, t]).shape)
-        yield tf.stack([s, t]), segs
-
-def generator_tensors_ids_dev():
-    global tokenizer_bert, tokenizer_ro, args
-    gen = generator_ids_dev(tokenizer_ro, tokenizer_bert, args)
-    for step, ((s, t), segs) in enumerate(gen):
-        if step % 10000 == 0:
-            tf.compat.v1.logging.info('tf record generation, step {}'.format(step))
-        s = tf.convert_to_tensor(s, dtype=tf.int64)
-        t = tf.convert_to_tensor(t, dtype=tf.int64)
-        segs = tf.convert_to_tensor(segs, dtype=tf.int64)
-        # print(s.shape, t.shape, segs.shape, tf.stack([s, t]).shape)
-        yield tf.stack([s, t]), segs
-
-def generator_tensors_ids_and_segs():
-    global tokenizer_bert, tokenizer_ro, args
-
-    gen = generator_ids(tokenizer_ro, tokenizer_bert, args)
-    for step, ((s, t), segs) in enumerate(gen):
-        if step % 10000 == 0:
-            tf.compat.v1.logging.info('tf record generation, step {}'.format(step))
-        
-        yield (tf.convert_to_tensor(s, dtype=tf.int64), tf.convert_to_tensor(t, dtype=tf.int64)),\
-                tf.convert_to_tensor(segs, dtype=tf.int64)
-
-def generator_tensors_ids_and_segs_dev():
-    global tokenizer_bert, tokenizer_ro, args
-
-    gen = generator_ids_dev(tokenizer_ro, tokenizer_bert, args)
-    for step, ((s, t), segs) in enumerate(gen):
-        if step % 10000 == 0:
-            tf.compat.v1.logging.info('tf record generation, step {}'.format(step))
-        
-        yield (tf.convert_to_tensor(s, dtype=tf.int64), tf.convert_to_tensor(t, dtype=tf.int64)),\
-                tf.convert_to_tensor(segs, dtype=tf.int64)   
+def encode_gec(source: str, target: str, tokenizer_ro, tokenizer_bert, args):
+    """padded pair, None if it is longer than args.seq_length"""
+    example = encode_gec_ids(source, target, tokenizer_ro, tokenizer_bert, args)
+    return None if example is None else pad_gec(*example, args)
+
+def pack_gec_examples(examples, args):
+    """greedily concatenates consecutive (source, target) pairs in rows of args.seq_length.
+    segments are [source_segments, target_segments], the k-th pair of a row has segment
+    id k (starting from 1) both in source and target, padding has segment id 0"""
+    sources, targets, source_segs, target_segs = [], [], [], []
+
+    def flush():
+        segments = [make_fixed_length(source_segs, args.seq_length),
+                    make_fixed_length(target_segs, args.seq_length)]
+        return (make_fixed_length(sources, args.seq_length),
+                make_fixed_length(targets, args.seq_length)), segments
+
+    for source, target in examples:
+        if sources and (len(sources) + len(source) > args.seq_length or
+                        len(targets) + len(target) > args.seq_length):
+            yield flush()
+            sources, targets, source_segs, target_segs = [], [], [], []
+        segment_id = (source_segs[-1] if source_segs else 0) + 1
+        sources.extend(source)
+        targets.extend(target)
+        source_segs.extend([segment_id] * len(source))
+        target_segs.extend([segment_id] * len(target))
+
+    if sources:
+        yield flush()
 
 def get_text_samples(args) -> List[str]:
     gen = gec_generator_text(args)
     return gen
 
-def construct_tokenizer(examples: List, subwords_path, args):
+def construct_tokenizer(dataset_files: List[str], subwords_path, args):
 
-    if examples is None:
-        tokenizer_ro = tfds.features.text.SubwordTextEncoder.load_from_file(subwords_path)
+    if dataset_files is None:
+        tokenizer_ro = FastSubwordTextEncoder.load_from_file(subwords_path)
         return tokenizer_ro
 
-    merged_examples = []
-    for (source, target) in examples:
-        merged_examples.append(source)
-        merged_examples.append(target)
-
-    tokenizer_ro = tfds.features.text.SubwordTextEncoder.build_from_corpus(
-            merged_examples, target_vocab_size=args.dict_size)
+    # every line of the files (sources and targets) is counted
+    tokenizer_ro = FastSubwordTextEncoder.build_from_files(dataset_files, target_vocab_size=args.dict_size,
+                                        workers=get_num_workers(args), sample=args.vocab_sample)
     
     if not os.path.exists(subwords_path):
         os.makedirs(subwords_path)
@@ -1,35 +1,53 @@
 import tensorflow as tf
-from transformer.utils import positional_encoding
+from transformer.utils import positional_encoding, recompute_layer
 from transformer.decoder_layer import DecoderLayer
 
 class Decoder(tf.keras.layers.Layer):
     def __init__(self, num_layers, d_model, num_heads, dff, target_vocab_size,
-               maximum_position_encoding, rate=0.1):
+               maximum_position_encoding, rate=0.1, recompute=False, embedding=None):
         super(Decoder, self).__init__()
 
         self.d_model = d_model
         self.num_layers = num_layers
+        self.recompute = recompute
         
-        self.embedding = tf.keras.layers.Embedding(target_vocab_size, d_model)
-        self.pos_encoding = positional_encoding(maximum_position_encoding, d_model)
+        if embedding is None:
+            embedding = tf.keras.layers.Embedding(target_vocab_size, d_model)
+        self.embedding = embedding
+        # the positional table is computed at the first call
+        self.maximum_position_encoding = maximum_position_encoding
+        self.pos_encoding = None
         
         self.dec_layers = [DecoderLayer(d_model, num_heads, dff, rate) 
                         for _ in range(num_layers)]
         self.dropout = tf.keras.layers.Dropout(rate)
         
+    def build(self, input_shape):
+        self.pos_encoding = positional_encoding(self.maximum_position_encoding, self.d_model)
+        super(Decoder, self).build(input_shape)
+
     def call(self, x, enc_output, training, 
-           look_ahead_mask, padding_mask):
+           look_ahead_mask, padding_mask, positions=None):
 
         seq_len = tf.shape(x)[1]
         attention_weights = {}
         
         x = self.embedding(x)  # (batch_size, target_seq_len, d_model)
         x *= tf.math.sqrt(tf.cast(self.d_model, tf.float32))
-        x += self.pos_encoding[:, :seq_len, :]
+        if positions is None:
+            x += self.pos_encoding[:, :seq_len, :]
+        else:
+            # packed rows, positions restart for each example
+            x += tf.gather(self.pos_encoding[0], positions)
         
         x = self.dropout(x, training=training)
 
         for i in range(self.num_layers):
+            if self.recompute and training:
+                # attention weights are not kept when recomputing
+                x = recompute_layer(self.dec_layers[i], [x, enc_output], training,
+                                    look_ahead_mask, padding_mask)
+                continue
             x, block1, block2 = self.dec_layers[i](x, enc_output, training,
                                                 look_ahead_mask, padding_mask)
         
@@ -1,6 +1,6 @@
 import tensorflow as tf
 from transformer.multi_head_attention import MultiHeadAttention
-from transformer.utils import point_wise_feed_forward_network
+from transformer.utils import point_wise_feed_forward_network, SeededDropout, offset_seed
 
 class DecoderLayer(tf.keras.layers.Layer):
     def __init__(self, d_model, num_heads, dff, rate=0.1):
@@ -15,26 +15,27 @@ class DecoderLayer(tf.keras.layers.Layer):
         self.layernorm2 = tf.keras.layers.LayerNormalization(epsilon=1e-6)
         self.layernorm3 = tf.keras.layers.LayerNormalization(epsilon=1e-6)
 
-        self.dropout1 = tf.keras.layers.Dropout(rate)
-        self.dropout2 = tf.keras.layers.Dropout(rate)
-        self.dropout3 = tf.keras.layers.Dropout(rate)
+        self.dropout1 = SeededDropout(rate)
+        self.dropout2 = SeededDropout(rate)
+        self.dropout3 = SeededDropout(rate)
 
 
     def call(self, x, enc_output, training, 
-            look_ahead_mask, padding_mask):
+            look_ahead_mask, padding_mask, seed=None):
         # enc_output.shape == (batch_size, input_seq_len, d_model)
+        # seed is given by recompute_layer, the recomputation draws the same dropout masks
 
         attn1, attn_weights_block1 = self.mha1(x, x, x, look_ahead_mask)  # (batch_size, target_seq_len, d_model)
-        attn1 = self.dropout1(attn1, training=training)
+        attn1 = self.dropout1(attn1, training=training, seed=offset_seed(seed, 1))
         out1 = self.layernorm1(attn1 + x)
 
         attn2, attn_weights_block2 = self.mha2(
             enc_output, enc_output, out1, padding_mask)  # (batch_size, target_seq_len, d_model)
-        attn2 = self.dropout2(attn2, training=training)
+        attn2 = self.dropout2(attn2, training=training, seed=offset_seed(seed, 2))
         out2 = self.layernorm2(attn2 + out1)  # (batch_size, target_seq_len, d_model)
 
         ffn_output = self.ffn(out2)  # (batch_size, target_seq_len, d_model)
-        ffn_output = self.dropout3(ffn_output, training=training)
+        ffn_output = self.dropout3(ffn_output, training=training, seed=offset_seed(seed, 3))
         out3 = self.layernorm3(ffn_output + out2)  # (batch_size, target_seq_len, d_model)
 
         return out3, attn_weights_block1, attn_weights_block2
\ No newline at end of file
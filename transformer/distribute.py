@@ -0,0 +1,83 @@
+import json
+import os
+import tempfile
+
+import tensorflow as tf
+
+DISTRIBUTIONS = ['', 'mirrored', 'multi_worker']
+
+
+def get_tf_config():
+    return json.loads(os.environ.get('TF_CONFIG', '{}'))
+
+def get_worker_index():
+    """index of this worker in TF_CONFIG, 0 when training on a single machine"""
+    task = get_tf_config().get('task', {})
+    return task.get('index', 0) if task.get('type', 'worker') == 'worker' else 0
+
+def is_chief():
+    return get_worker_index() == 0
+
+def get_worker_path(path: str):
+    """the chief writes to path, the other workers to their own temporary copy"""
+    if is_chief():
+        return path
+    return os.path.join(tempfile.gettempdir(), 'worker_{}'.format(get_worker_index()), os.path.basename(path))
+
+def get_strategy(args):
+    """tpu, multi worker (cluster described by TF_CONFIG, one process per worker) or mirrored
+    (all the devices of this machine) strategy, None for a single device"""
+    if args.use_tpu:
+        tpu_cluster_resolver = tf.distribute.cluster_resolver.TPUClusterResolver(args.tpu,
+             zone=args.tpu_zone, project=args.gcp_project)
+        tf.config.experimental_connect_to_cluster(tpu_cluster_resolver)
+        tf.tpu.experimental.initialize_tpu_system(tpu_cluster_resolver)
+        strategy = tf.distribute.experimental.TPUStrategy(tpu_cluster_resolver)
+        tf.compat.v1.logging.info('Running on TPU {}'.format(tpu_cluster_resolver.cluster_spec().as_dict()['worker']))
+    elif args.distribution == 'multi_worker':
+        strategy = tf.distribute.experimental.MultiWorkerMirroredStrategy()
+        tf.compat.v1.logging.info('Running on worker {} of {}'.format(
+            get_worker_index(), get_tf_config().get('cluster', {}).get('worker')))
+    elif args.distribution == 'mirrored':
+        strategy = tf.distribute.MirroredStrategy()
+    elif args.distribution:
+        raise ValueError('distribution must be one of {}, got {}'.format(DISTRIBUTIONS, args.distribution))
+    else:
+        return None
+    tf.compat.v1.logging.info('replicas in sync: {}'.format(strategy.num_replicas_in_sync))
+    return strategy
+
+def run_on_replicas(strategy, fn, args):
+    """strategy.run, named experimental_run_v2 in older tf versions"""
+    if hasattr(strategy, 'run'):
+        return strategy.run(fn, args=args)
+    return strategy.experimental_run_v2(fn, args=args)
+
+def scale_to_global_tokens(loss, tokens):
+    """the gradients of the replicas are summed, a loss averaged over the tokens of the
+    replica is rescaled to its share of the mean over the tokens of all the replicas"""
+    replica_context = tf.distribute.get_replica_context()
+    global_tokens = replica_context.all_reduce(tf.distribute.ReduceOp.SUM, tokens)
+    return loss * tokens / global_tokens
+
+def distribute_datasets(strategy, train_dataset, dev_dataset, prepare_fn, batch_size=None, rows=(None, None)):
+    """each worker reads its shard of the unbatched datasets, prepare_fn(train, dev, replicas)
+    batches them for one replica. with the global batch_size and the nr of train / dev rows,
+    every worker stops after the same nr of batches, a worker waiting for the others would
+    block the training"""
+
+    def get_dataset_fn(index):
+        def dataset_fn(input_context):
+            datasets = [dataset.shard(input_context.num_input_pipelines, input_context.input_pipeline_id)
+                            for dataset in (train_dataset, dev_dataset)]
+            dataset = prepare_fn(*datasets, strategy.num_replicas_in_sync)[index]
+            if batch_size and rows[index] is not None:
+                local_replicas = strategy.num_replicas_in_sync // input_context.num_input_pipelines
+                replica_batch_size = input_context.get_per_replica_batch_size(batch_size)
+                steps = rows[index] // input_context.num_input_pipelines // replica_batch_size // local_replicas
+                dataset = dataset.take(steps * local_replicas)
+            return dataset
+        return dataset_fn
+
+    return [strategy.experimental_distribute_datasets_from_function(get_dataset_fn(index))
+                for index in range(2)]
@@ -1,18 +1,22 @@
 import tensorflow as tf
-from transformer.utils import positional_encoding
+from transformer.utils import positional_encoding, recompute_layer
 from transformer.encoder_layer import EncoderLayer
 
 class Encoder(tf.keras.layers.Layer):
     def __init__(self, num_layers, d_model, num_heads, dff, input_vocab_size,
-               maximum_position_encoding, rate=0.1):
+               maximum_position_encoding, rate=0.1, recompute=False, embedding=None):
         super(Encoder, self).__init__()
 
         self.d_model = d_model
         self.num_layers = num_layers
+        self.recompute = recompute
 
-        self.embedding = tf.keras.layers.Embedding(input_vocab_size, d_model)
-        self.pos_encoding = positional_encoding(maximum_position_encoding, 
-                                                self.d_model)
+        if embedding is None:
+            embedding = tf.keras.layers.Embedding(input_vocab_size, d_model)
+        self.embedding = embedding
+        # the positional table is computed at the first call
+        self.maximum_position_encoding = maximum_position_encoding
+        self.pos_encoding = None
 
 
         self.enc_layers = [EncoderLayer(d_model, num_heads, dff, rate) 
@@ -20,16 +24,27 @@ class Encoder(tf.keras.layers.Layer):
 
         self.dropout = tf.keras.layers.Dropout(rate)
             
-    def call(self, x, training, mask):
+    def build(self, input_shape):
+        self.pos_encoding = positional_encoding(self.maximum_position_encoding, self.d_model)
+        super(Encoder, self).build(input_shape)
+
+    def call(self, x, training, mask, positions=None):
         seq_len = tf.shape(x)[1]
 
         # adding embedding and position encoding.
         x = self.embedding(x)  # (batch_size, input_seq_len, d_model)
         x *= tf.math.sqrt(tf.cast(self.d_model, tf.float32))
-        x += self.pos_encoding[:, :seq_len, :]
+        if positions is None:
+            x += self.pos_encoding[:, :seq_len, :]
+        else:
+            # packed rows, positions restart for each example
+            x += tf.gather(self.pos_encoding[0], positions)
 
         x = self.dropout(x, training=training)
 
         for i in range(self.num_layers):
-            x = self.enc_layers[i](x, training, mask)
+            if self.recompute and training:
+                x = recompute_layer(self.enc_layers[i], [x], training, mask)
+            else:
+                x = self.enc_layers[i](x, training, mask)
         return x  # (batch_size, input_seq_len, d_model)
\ No newline at end of file
@@ -0,0 +1,75 @@
+import json
+import os
+from os.path import join
+
+import numpy as np
+import tensorflow as tf
+
+FEATURES_FILE = 'features.bin'
+OFFSETS_FILE = 'offsets.npy'
+META_FILE = 'meta.json'
+
+
+def read_encoder_cache_meta(path: str):
+    """meta of the cache, None if there is no cache in path"""
+    meta_path = join(path, META_FILE)
+    if not os.path.isfile(meta_path):
+        return None
+    with open(meta_path, 'r') as f:
+        return json.load(f)
+
+def write_encoder_cache(path: str, store, encode_fn, info: dict, batch_size: int, fp16: bool = True):
+    """runs encode_fn(ids, segs) -> (batch, length, d_model) once over the examples of the token
+    store (not packed) and writes the outputs of the source tokens, without the padding.
+    offsets[i] is the first output row of example i. the padding outputs are not stored,
+    they are masked in the decoder attention"""
+    if not os.path.exists(path):
+        os.makedirs(path)
+    dtype = np.float16 if fp16 else np.float32
+    source_lengths = np.minimum(np.diff(store.offsets)[0::2], store.seq_length)
+    offsets = np.concatenate([[0], np.cumsum(source_lengths)]).astype(np.int64)
+
+    d_model = 0
+    with open(join(path, FEATURES_FILE), 'wb') as f:
+        for start in range(0, len(store), batch_size):
+            rows = np.arange(start, min(start + batch_size, len(store)))
+            data, segs = store.get_rows(rows)
+            # the bert attention ignores the padding, the batch is cut to its longest source
+            length = max(1, int(source_lengths[rows].max()))
+            outputs = encode_fn(data[:, 0, :length], segs[:, :length]).numpy()
+            d_model = outputs.shape[-1]
+            for b, row in enumerate(rows):
+                f.write(outputs[b, :source_lengths[row]].astype(dtype).tobytes())
+
+    np.save(join(path, OFFSETS_FILE), offsets)
+    meta = dict(info, dtype=np.dtype(dtype).name, d_model=d_model, examples=len(store), tokens=int(offsets[-1]))
+    with open(join(path, META_FILE), 'w') as f:
+        json.dump(meta, f, indent=2)
+    tf.compat.v1.logging.info('encoder cache written in {}, {} examples {} tokens'.format(
+        path, meta['examples'], meta['tokens']))
+    return meta
+
+class EncoderCache(object):
+    """memory mapped encoder outputs written by write_encoder_cache, read padded
+    to seq_length with zeros, in the row order of the token store"""
+
+    def __init__(self, path: str, seq_length: int):
+        self.meta = read_encoder_cache_meta(path)
+        self.seq_length = seq_length
+        self.d_model = self.meta['d_model']
+        self.dtype = tf.as_dtype(self.meta['dtype'])
+        if self.meta['tokens'] > 0:
+            self.features = np.memmap(join(path, FEATURES_FILE), dtype=self.meta['dtype'], mode='r')
+            self.features = self.features.reshape((-1, self.d_model))
+        else:
+            self.features = np.zeros((0, self.d_model), dtype=self.meta['dtype'])
+        self.offsets = np.load(join(path, OFFSETS_FILE), mmap_mode='r')
+
+    def get_rows(self, rows):
+        """encoder outputs (len(rows), seq_length, d_model) of the examples"""
+        outputs = np.zeros((len(rows), self.seq_length, self.d_model), dtype=self.meta['dtype'])
+        for b, row in enumerate(rows):
+            start, end = self.offsets[row], self.offsets[row + 1]
+            end = min(end, start + self.seq_length)
+            outputs[b, :end - start] = self.features[start:end]
+        return outputs
@@ -1,6 +1,6 @@
 import tensorflow as tf
 from transformer.multi_head_attention import MultiHeadAttention
-from transformer.utils import point_wise_feed_forward_network
+from transformer.utils import point_wise_feed_forward_network, SeededDropout, offset_seed
 
 class EncoderLayer(tf.keras.layers.Layer):
     def __init__(self, d_model, num_heads, dff, rate=0.1):
@@ -12,16 +12,17 @@ class EncoderLayer(tf.keras.layers.Layer):
         self.layernorm1 = tf.keras.layers.LayerNormalization(epsilon=1e-6)
         self.layernorm2 = tf.keras.layers.LayerNormalization(epsilon=1e-6)
 
-        self.dropout1 = tf.keras.layers.Dropout(rate)
-        self.dropout2 = tf.keras.layers.Dropout(rate)
+        self.dropout1 = SeededDropout(rate)
+        self.dropout2 = SeededDropout(rate)
 
-    def call(self, x, training, mask):
+    def call(self, x, training, mask, seed=None):
+        # seed is given by recompute_layer, the recomputation draws the same dropout masks
         attn_output, _ = self.mha(x, x, x, mask)  # (batch_size, input_seq_len, d_model)
-        attn_output = self.dropout1(attn_output, training=training)
+        attn_output = self.dropout1(attn_output, training=training, seed=offset_seed(seed, 1))
         out1 = self.layernorm1(x + attn_output)  # (batch_size, input_seq_len, d_model)
 
         ffn_output = self.ffn(out1)  # (batch_size, input_seq_len, d_model)
-        ffn_output = self.dropout2(ffn_output, training=training)
+        ffn_output = self.dropout2(ffn_output, training=training, seed=offset_seed(seed, 2))
         out2 = self.layernorm2(out1 + ffn_output)  # (batch_size, input_seq_len, d_model)
 
         return out2
\ No newline at end of file
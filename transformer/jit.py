@@ -0,0 +1,57 @@
+import inspect
+
+import tensorflow as tf
+
+# decoding pads the growing sequences to multiples of it, one compilation per bucket
+DECODE_BUCKET = 16
+
+
+def supports_function_compile():
+    """tf.function(experimental_compile=True) is not available in every tf 2 release"""
+    return 'experimental_compile' in inspect.signature(tf.function).parameters
+
+def enable_jit(jit_compile: bool):
+    """without compilation per function, falls back to xla auto clustering of every graph"""
+    if jit_compile and not supports_function_compile():
+        tf.compat.v1.logging.warning('tf.function can not be compiled in this tf version, '
+                                     'using xla auto clustering')
+        tf.config.optimizer.set_jit(True)
+
+class TracedFunction(object):
+    """tf.function (xla compiled with jit_compile) that counts its traces and the distinct
+    shapes it is called with. xla compiles once per shape, a growing count of shapes
+    means the inputs are not bucketed enough"""
+
+    def __init__(self, fn, name: str, input_signature=None, jit_compile: bool = False):
+        self.name = name
+        self.traces = 0
+        self.shapes = set()
+
+        def traced_fn(*args):
+            # python code only runs when tracing
+            self.traces += 1
+            tf.compat.v1.logging.info('{} traced ({} traces)'.format(self.name, self.traces))
+            return fn(*args)
+
+        kwargs = {}
+        if jit_compile and supports_function_compile():
+            kwargs['experimental_compile'] = True
+        self.function = tf.function(traced_fn, input_signature=input_signature, **kwargs)
+
+    def __call__(self, *args):
+        shape = tuple(tuple(arg.shape) for arg in tf.nest.flatten(args))
+        if shape not in self.shapes:
+            self.shapes.add(shape)
+            tf.compat.v1.logging.info('{} called with a new shape {} ({} shapes)'.format(
+                self.name, shape, len(self.shapes)))
+        return self.function(*args)
+
+def get_bucket_length(length: int, bucket: int = DECODE_BUCKET):
+    return (length + bucket - 1) // bucket * bucket
+
+def pad_to_bucket(ids, max_length: int, bucket: int = DECODE_BUCKET):
+    """pads the last dimension of a (batch, length) tensor to a multiple of bucket,
+    at most max_length"""
+    length = ids.shape[-1]
+    padded_length = max(length, min(get_bucket_length(length, bucket), max_length))
+    return tf.pad(ids, [[0, 0], [0, padded_length - length]])
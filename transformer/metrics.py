@@ -0,0 +1,37 @@
+import json
+import time
+
+import tensorflow as tf
+
+
+class StepMetrics(object):
+    """loss and accuracy of a stage (train / dev) accumulated by the compiled steps.
+    batches are weighted by their nr of target tokens, so the result is the mean over
+    the tokens of the epoch and not the mean of the batch means"""
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.loss = tf.keras.metrics.Mean(name=stage + '_loss')
+        self.accuracy = tf.keras.metrics.Mean(name=stage + '_accuracy')
+        self.tokens = tf.keras.metrics.Sum(name=stage + '_tokens')
+
+    def update(self, loss, accuracy, tokens):
+        """loss and accuracy are means over the tokens of the batch"""
+        self.loss.update_state(loss, sample_weight=tokens)
+        self.accuracy.update_state(accuracy, sample_weight=tokens)
+        self.tokens.update_state(tokens)
+
+    def reset(self):
+        for metric in (self.loss, self.accuracy, self.tokens):
+            metric.reset_states()
+
+    def result(self):
+        return {'loss': float(self.loss.result().numpy()),
+                'accuracy': float(self.accuracy.result().numpy()),
+                'tokens': int(self.tokens.result().numpy())}
+
+def write_metrics(metrics_log, epoch: int, stage: str, batch_idx, result: dict):
+    """one json line per flush, batch_idx is None for the end of the epoch"""
+    record = dict(result, time=time.time(), epoch=epoch + 1, stage=stage, batch=batch_idx)
+    metrics_log.write(json.dumps(record) + '\n')
+    metrics_log.flush()
@@ -0,0 +1,23 @@
+# model options when the flags are not set and no preset overrides them
+MODEL_DEFAULTS = {'num_layers': 6, 'dff': 2048, 'num_heads': 8, 'dropout': 0.1,
+                  'dict_size': 2**15, 'seq_length': 512, 'max_seq_decoding': 768}
+
+# options implied by --d_model, they override the flags
+MODEL_PRESETS = {
+    64: {'seq_length': 64, 'dff': 64, 'num_heads': 2, 'num_layers': 2,
+         'max_seq_decoding': 64, 'dict_size': 1024, 'dropout': 0.2},
+    128: {'seq_length': 128, 'dff': 128, 'num_heads': 2, 'num_layers': 3,
+          'max_seq_decoding': 128, 'dict_size': 2048, 'dropout': 0.2},
+    256: {'seq_length': 256},
+    768: {'seq_length': 512},
+}
+
+
+def apply_model_presets(args):
+    """sets the options of the args.d_model preset, the other options keep their value"""
+    for name, value in MODEL_PRESETS.get(args.d_model, {}).items():
+        setattr(args, name, value)
+
+def get_model_config(d_model: int):
+    """all the model options of the d_model preset, the defaults for the ones it does not set"""
+    return dict(MODEL_DEFAULTS, d_model=d_model, **MODEL_PRESETS.get(d_model, {}))
@@ -0,0 +1,141 @@
+import collections
+import contextlib
+import json
+import math
+import time
+
+import tensorflow as tf
+
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(sorted_values, q):
+    """nearest rank percentile of sorted values"""
+    if not sorted_values:
+        return None
+    # smallest value with at least q% of the values <= it
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(q / 100.0 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+def supports_profiler_api():
+    """tf.profiler.experimental.start / stop are not available in every tf 2 release"""
+    return hasattr(tf.profiler, 'experimental') and hasattr(tf.profiler.experimental, 'start')
+
+def start_trace(logdir: str):
+    if supports_profiler_api():
+        tf.profiler.experimental.start(logdir)
+    else:
+        tf.summary.trace_on(graph=False, profiler=True)
+
+def stop_trace(logdir: str):
+    if supports_profiler_api():
+        tf.profiler.experimental.stop()
+    else:
+        with tf.summary.create_file_writer(logdir).as_default():
+            tf.summary.trace_export('trace', step=0, profiler_outdir=logdir)
+
+def parse_trace_steps(trace_steps: str):
+    """'first,last' steps (train batches or decoded sentences) of the trace window"""
+    first, last = (int(step) for step in trace_steps.split(','))
+    return first, last
+
+class Profiler(object):
+    """wall time of named phases (data wait, train step, decode step...), counts of processed
+    items (tokens, sentences) and a tf profiler trace of a window of steps. disabled, the
+    phases cost a context manager and nothing is synchronized.
+    tf ops run asynchronously on gpu, sync() waits for the outputs of a phase"""
+
+    def __init__(self, enabled: bool = False, trace_dir: str = '', trace_steps: str = '10,20'):
+        self.enabled = enabled
+        self.trace_dir = trace_dir
+        self.trace_window = parse_trace_steps(trace_steps) if trace_dir else None
+        self.tracing = False
+        self.reset()
+
+    def reset(self):
+        self.durations = collections.defaultdict(list)
+        self.counts = collections.Counter()
+        self.start = time.time()
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        yield
+        self.durations[name].append(time.perf_counter() - start)
+
+    def add(self, name: str, seconds: float):
+        if self.enabled:
+            self.durations[name].append(seconds)
+
+    def timed(self, iterator, name: str):
+        """yields the items of iterator, the wait for each item is a phase"""
+        iterator = iter(iterator)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add(name, time.perf_counter() - start)
+            yield item
+
+    def sync(self, outputs):
+        """waits for the tensors of outputs when enabled"""
+        if self.enabled:
+            for tensor in tf.nest.flatten(outputs):
+                if hasattr(tensor, 'numpy'):
+                    tensor.numpy()
+
+    def count(self, **counts):
+        if self.enabled:
+            self.counts.update(counts)
+
+    def step(self, step: int):
+        """starts / stops the trace at the bounds of the trace window, traces only once"""
+        if self.trace_window is None:
+            return
+        first, last = self.trace_window
+        if step == first and not self.tracing:
+            tf.compat.v1.logging.info('profiler trace started at step {} in {}'.format(step, self.trace_dir))
+            start_trace(self.trace_dir)
+            self.tracing = True
+        elif step == last and self.tracing:
+            stop_trace(self.trace_dir)
+            self.tracing = False
+            self.trace_window = None
+            tf.compat.v1.logging.info('profiler trace stopped at step {}'.format(step))
+
+    def report(self):
+        """total, mean and percentiles (ms) of each phase, its share of the wall time and the
+        items / sec of each count"""
+        wall = time.time() - self.start
+        phases = {}
+        for name, durations in self.durations.items():
+            values = sorted(durations)
+            phase = {'count': len(values), 'total_sec': sum(values),
+                     'mean_ms': 1000 * sum(values) / len(values), 'share': sum(values) / wall if wall else None}
+            for q in PERCENTILES:
+                phase['p{}_ms'.format(q)] = 1000 * percentile(values, q)
+            phases[name] = phase
+        throughput = {'{}_per_sec'.format(name): count / wall if wall else None
+                          for name, count in self.counts.items()}
+        return {'wall_sec': wall, 'phases': phases, 'throughput': throughput, 'counts': dict(self.counts)}
+
+    def log_report(self, stage: str, report_file: str = '', **extra):
+        """logs the report and appends it as a json line to report_file"""
+        if not self.enabled:
+            return None
+        report = dict(self.report(), stage=stage, time=time.time(), **extra)
+        for name, phase in sorted(report['phases'].items(), key=lambda item: -item[1]['total_sec']):
+            tf.compat.v1.logging.info('{} {}: {:.1f}s ({:.0%}) mean {:.2f}ms p50 {:.2f}ms p90 {:.2f}ms p99 {:.2f}ms'.format(
+                stage, name, phase['total_sec'], phase['share'] or 0, phase['mean_ms'],
+                phase['p50_ms'], phase['p90_ms'], phase['p99_ms']))
+        for name, value in sorted(report['throughput'].items()):
+            tf.compat.v1.logging.info('{} {}: {:.2f}'.format(stage, name, value or 0))
+        if report_file:
+            with open(report_file, 'at') as f:
+                f.write(json.dumps(report) + '\n')
+        return report
@@ -1,15 +1,28 @@
+import json
 import os
 from os import listdir
 from os.path import isfile, join
 
 import numpy as np
 import tensorflow as tf
-import tensorflow_datasets as tfds
+from transformer.subword_tokenizer import FastSubwordTextEncoder
 from bert.tokenization.bert_tokenization import FullTokenizer
 from google.cloud import storage
+from transformer.utils import get_epoch_seed
 
 args = None
 
+MANIFEST_FILE = 'manifest.json'
+# serialized records parsed together by one parse_example call
+PARSE_BATCH = 256
+# width of the bins of the length histograms stored with the datasets
+LENGTH_BIN = 8
+# train shards read at the same time, the shards are the unit of the shuffle
+SHARD_CYCLE = 16
+# narrow ids are stored as raw bytes, numpy type for writing and tf type for reading
+RECORD_DTYPES = {'uint16': (np.uint16, tf.uint16), 'int32': (np.int32, tf.int32)}
+RECORD_COMPRESSIONS = ['', 'GZIP', 'ZLIB']
+
 def _bytes_feature(value):
     """Returns a bytes_list from a string / byte."""
     if isinstance(value, type(tf.constant(0))):
@@ -24,6 +37,10 @@ def _int64_feature(value):
     """Returns an int64_list from a bool / enum / int / uint."""
     return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
 
+def _int64_list_feature(values):
+    """Returns an int64_list from a list of ints."""
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=values))
+
 def _tensor_feature(value):
     """converts a tensor to serialized byte string"""
     return  _bytes_feature(tf.io.serialize_tensor(value))
@@ -73,6 +90,56 @@ def serialize_example_ids(sentences, seg):
     example_proto = tf.train.Example(features=tf.train.Features(feature=feature))
     return example_proto.SerializeToString()
 
+def serialize_example_int64(source, target, seg):
+    """
+    Creates a tf.Example message with the ids stored as native int64 lists,
+    seg is a list of ints or, for packed rows, a list of 2 lists (flattened).
+    """
+    if seg and isinstance(seg[0], list):
+        seg = [s for segs in seg for s in segs]
+    feature = {
+        'source': _int64_list_feature(source),
+        'target': _int64_list_feature(target),
+        'seg': _int64_list_feature(seg),
+    }
+    example_proto = tf.train.Example(features=tf.train.Features(feature=feature))
+    return example_proto.SerializeToString()
+
+def _ids_feature(values, dtype):
+    if dtype == 'int64':
+        return _int64_list_feature(values)
+    return _bytes_feature(np.asarray(values, dtype=RECORD_DTYPES[dtype][0]).tobytes())
+
+def strip_padding(ids):
+    """ids without the trailing padding (ids of tokens are never 0)"""
+    length = len(ids)
+    while length and ids[length - 1] == 0:
+        length -= 1
+    return ids[:length]
+
+def serialize_example_row(source, target, seg, dtype='int64', padded=True):
+    """
+    Creates a tf.Example message for a padded row of the dataset, ids stored as int64 lists
+    or, for narrow dtypes, as raw bytes. unpadded rows keep only the tokens of the source and
+    target (and their segments for packed rows), the reader pads them again.
+    """
+    if padded and dtype == 'int64':
+        return serialize_example_int64(source, target, seg)
+    packed = bool(seg) and isinstance(seg[0], list)
+    if padded:
+        if packed:
+            seg = [s for segs in seg for s in segs]
+        features = {'source': source, 'target': target, 'seg': seg}
+    else:
+        source, target = strip_padding(source), strip_padding(target)
+        features = {'source': source, 'target': target}
+        if packed:
+            features['source_seg'] = seg[0][:len(source)]
+            features['target_seg'] = seg[1][:len(target)]
+    feature = {name: _ids_feature(values, dtype) for name, values in features.items()}
+    example_proto = tf.train.Example(features=tf.train.Features(feature=feature))
+    return example_proto.SerializeToString()
+
 def tf_serialize_example_ids(sentences, seg):
     tf_string = tf.py_function(
         serialize_example_ids,
@@ -141,13 +208,133 @@ def parse_example_ids(example):
 
     seg = parsed_example['seg']
     seg = tf.io.parse_tensor(seg, out_type=tf.int64)
-    seg = tf.reshape(seg, shape=(args.seq_length, ))
+    if args.pack:
+        seg = tf.reshape(seg, shape=(2, args.seq_length))
+    else:
+        seg = tf.reshape(seg, shape=(args.seq_length, ))
 
     sentences = parsed_example['sentences']
     sentences = tf.io.parse_tensor(sentences, out_type=tf.int64)
     sentences = tf.reshape(sentences, shape=(2, args.seq_length))
     return sentences, seg
 
+def get_seg_shape():
+    return (2, args.seq_length) if args.pack else (args.seq_length, )
+
+def get_int64_feature_description():
+    return {
+        'source': tf.io.FixedLenFeature((args.seq_length, ), tf.int64),
+        'target': tf.io.FixedLenFeature((args.seq_length, ), tf.int64),
+        'seg': tf.io.FixedLenFeature((len(get_seg_shape()) * args.seq_length, ), tf.int64),
+    }
+
+def parse_example_int64(example):
+    parsed_example = tf.io.parse_single_example(example, get_int64_feature_description())
+
+    sentences = tf.stack([parsed_example['source'], parsed_example['target']])
+    seg = tf.reshape(parsed_example['seg'], shape=get_seg_shape())
+    return sentences, seg
+
+def parse_examples_int64(examples):
+    """vectorized version of parse_example_int64, parses a batch of serialized records"""
+    parsed_examples = tf.io.parse_example(examples, get_int64_feature_description())
+
+    sentences = tf.stack([parsed_examples['source'], parsed_examples['target']], axis=1)
+    seg = tf.reshape(parsed_examples['seg'], shape=(-1, ) + get_seg_shape())
+    return sentences, seg
+
+def is_int64_padded(manifest):
+    """records written before the storage options are padded int64 lists"""
+    return manifest.get('dtype', 'int64') == 'int64' and manifest.get('padded', True)
+
+def get_record_feature_description(manifest):
+    dtype, padded = manifest.get('dtype', 'int64'), manifest.get('padded', True)
+    names = ['source', 'target']
+    if padded:
+        names.append('seg')
+    elif args.pack:
+        names.extend(['source_seg', 'target_seg'])
+    if dtype == 'int64':
+        return {name: tf.io.VarLenFeature(tf.int64) for name in names}
+    return {name: tf.io.FixedLenFeature((), tf.string) for name in names}
+
+def parse_records(examples, manifest):
+    """batched parse of the records of the narrow / unpadded formats, the rows are
+    decoded one by one by decode_record"""
+    parsed_examples = tf.io.parse_example(examples, get_record_feature_description(manifest))
+    return {name: tf.sparse.to_dense(value) if isinstance(value, tf.SparseTensor) else value
+                for name, value in parsed_examples.items()}
+
+def decode_record(features, manifest):
+    """rebuilds the padded row (same as parse_example_int64) from the parsed features"""
+    dtype = manifest.get('dtype', 'int64')
+
+    def get_ids(name):
+        ids = features[name]
+        if dtype != 'int64':
+            ids = tf.cast(tf.io.decode_raw(ids, RECORD_DTYPES[dtype][1]), tf.int64)
+        return ids
+
+    def pad(ids):
+        ids = ids[:args.seq_length]
+        return tf.reshape(tf.pad(ids, [[0, args.seq_length - tf.shape(ids)[0]]]), (args.seq_length, ))
+
+    sentences = tf.stack([pad(get_ids('source')), pad(get_ids('target'))])
+    if manifest.get('padded', True):
+        seg = tf.reshape(get_ids('seg'), shape=get_seg_shape())
+    elif args.pack:
+        seg = tf.stack([pad(get_ids('source_seg')), pad(get_ids('target_seg'))])
+    else:
+        # same segments as dataset.pad_gec
+        source_length = tf.math.count_nonzero(sentences[0])
+        seg = tf.cast(tf.range(args.seq_length, dtype=tf.int64) >= source_length, tf.int64)
+    return sentences, seg
+
+def get_shard_name(split, shard, num_shards):
+    return '{}-{:05d}-of-{:05d}.tfrecord'.format(split, shard, num_shards)
+
+def write_manifest(path_tf_records, manifest):
+    with tf.io.gfile.GFile(join(path_tf_records, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+def read_manifest(path_tf_records):
+    """manifest of sharded tf records, None for the single file format"""
+    manifest_path = join(path_tf_records, MANIFEST_FILE)
+    if not tf.io.gfile.exists(manifest_path):
+        return None
+    with tf.io.gfile.GFile(manifest_path, 'r') as f:
+        return json.load(f)
+
+def get_length_stats(source_lengths, target_lengths):
+    """nr of examples, tokens and length histograms (bins of LENGTH_BIN tokens) of unpadded
+    examples, stored with the datasets so that they are not counted at startup"""
+    source_lengths = np.asarray(source_lengths, dtype=np.int64)
+    target_lengths = np.asarray(target_lengths, dtype=np.int64)
+    return {'examples': len(source_lengths),
+            'source_tokens': int(source_lengths.sum()),
+            'target_tokens': int(target_lengths.sum()),
+            'source_lengths': np.bincount(source_lengths // LENGTH_BIN).tolist(),
+            'target_lengths': np.bincount(target_lengths // LENGTH_BIN).tolist()}
+
+def merge_length_stats(stats_list):
+    merged = get_length_stats([], [])
+    for stats in stats_list:
+        for key in ('examples', 'source_tokens', 'target_tokens'):
+            merged[key] += stats[key]
+        for key in ('source_lengths', 'target_lengths'):
+            histogram = merged[key] + [0] * (len(stats[key]) - len(merged[key]))
+            for i, count in enumerate(stats[key]):
+                histogram[i] += count
+            merged[key] = histogram
+    return merged
+
+def get_manifest_files(manifest, path_tf_records):
+    """all the files described by the manifest, manifest included"""
+    files = [join(path_tf_records, MANIFEST_FILE)]
+    for split in manifest['splits'].values():
+        files.extend(join(path_tf_records, f) for f in split['files'])
+    return files
+
 def example_encode_text_dataset(args, filename='test.tfrecord'):
     serialized_features_dataset = tf.data.Dataset.from_generator(
         generator_text, output_types=tf.string, output_shapes=())
@@ -170,7 +357,8 @@ def serialize_ids_dataset(dataset, args, filename='train.tfrecord'):
     writer = tf.data.experimental.TFRecordWriter(tf_records_path)
     writer.write(serialized_dataset)
 
-def get_ids_dataset_tf_records(args1):
+def get_ids_dataset_tf_records(args1, epoch=0):
+    """train and dev datasets of the tf records, the train order is the one of epoch"""
     global args
     args = args1
     # get dataset
@@ -178,6 +366,11 @@ def get_ids_dataset_tf_records(args1):
     if args.use_tpu:
         path_tf_records = join('gs://', args.bucket, path_tf_records)
 
+    manifest = read_manifest(path_tf_records)
+    if manifest is not None:
+        return get_sharded_dataset(manifest, path_tf_records, 'train', get_epoch_seed(args.shuffle_seed, epoch)),\
+            get_sharded_dataset(manifest, path_tf_records, 'dev')
+
     train_tf_record_file = join(path_tf_records, 'train.tfrecord')
     dev_tf_record_file = join(path_tf_records, 'dev.tfrecord')
 
@@ -190,16 +383,59 @@ def get_ids_dataset_tf_records(args1):
     dev_dataset = raw_dev_dataset.map(parse_example_ids)
     return train_dataset, dev_dataset
 
-def get_tokenizers_ckeckpoint(args1):
+def get_sharded_dataset(manifest, path_tf_records, split, seed=None):
+    if manifest['seq_length'] != args.seq_length or manifest['pack'] != args.pack:
+        raise ValueError('tf records in {} have seq_length {} pack {}, expected {} {}'.format(
+            path_tf_records, manifest['seq_length'], manifest['pack'], args.seq_length, args.pack))
+    files = [join(path_tf_records, f) for f in manifest['splits'][split]['files']]
+    tf.compat.v1.logging.info('restoring {} {} tf records from {}'.format(
+                        manifest['splits'][split]['total'], split, path_tf_records))
+
+    # shards are read concurrently, records are parsed in batches and then split again
+    # so that shuffling and batching stay the same as for the other datasets.
+    # each shard is a contiguous part of the corpus. the train shards are read SHARD_CYCLE
+    # at a time in a new order each epoch: with many more shards than SHARD_CYCLE each epoch
+    # mixes other parts of the corpus (with all the shards open at once the shard order
+    # would not change the order of the records)
+    dataset = tf.data.Dataset.from_tensor_slices(files)
+    cycle_length = len(files)
+    if split == 'train':
+        dataset = dataset.shuffle(len(files), seed=seed, reshuffle_each_iteration=True)
+        cycle_length = min(SHARD_CYCLE, len(files))
+        if len(files) < 4 * SHARD_CYCLE:
+            tf.compat.v1.logging.warning('{} train shards, the records are only mixed by the shuffle buffer, '
+                                         'regenerate them with --record_shards >= {}'.format(len(files), 4 * SHARD_CYCLE))
+    compression = manifest.get('compression', '')
+    dataset = dataset.interleave(lambda f: tf.data.TFRecordDataset(f, compression_type=compression),
+                                cycle_length=cycle_length, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.batch(PARSE_BATCH)
+    if is_int64_padded(manifest):
+        dataset = dataset.map(parse_examples_int64, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        dataset = dataset.unbatch()
+    else:
+        dataset = dataset.map(lambda examples: parse_records(examples, manifest),
+                                num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        dataset = dataset.unbatch()
+        dataset = dataset.map(lambda features: decode_record(features, manifest),
+                                num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+    options = tf.data.Options()
+    # a seed makes the order reproducible
+    options.experimental_deterministic = args.shuffle_seed is not None
+    return dataset.with_options(options).prefetch(tf.data.experimental.AUTOTUNE)
+
+def get_tokenizers_ckeckpoint(args1, path=None):
+    """tokenizers saved in the checkpoint dir, or in path (inference checkpoint)"""
     global args
     args = args1
-    tokenizer_ro_path = join(args.checkpoint, 'tokenizer_ro')
-    tokenizer_ro = tfds.features.text.SubwordTextEncoder.load_from_file(tokenizer_ro_path)
+    path = path or args.checkpoint
+    tokenizer_ro_path = join(path, 'tokenizer_ro')
+    tokenizer_ro = FastSubwordTextEncoder.load_from_file(tokenizer_ro_path)
     tf.compat.v1.logging.info('restoring ro tokenizer from {}'.format(tokenizer_ro_path))
 
     tokenizer_bert = None
     if args.bert:
-        tokenizer_bert_path = join(args.checkpoint, 'tokenizer_bert.vocab')
+        tokenizer_bert_path = join(path, 'tokenizer_bert.vocab')
         tokenizer_bert = FullTokenizer(vocab_file=tokenizer_bert_path)
         tokenizer_bert.vocab_size = len(tokenizer_bert.vocab)
         tf.compat.v1.logging.info('restoring bert tokenizer from {}'.format(tokenizer_bert_path))
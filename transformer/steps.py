@@ -0,0 +1,178 @@
+"""train, eval and decode steps of the gec transformer. they do not read the flags, transformer.py
+and the benchmarks build them from their own options"""
+import tensorflow as tf
+
+import beam_search
+from transformer.distribute import scale_to_global_tokens
+from transformer.jit import pad_to_bucket
+from transformer.profiling import Profiler
+from transformer.utils import create_masks, create_packed_masks, create_packed_loss_mask,\
+        segment_positions, unique_variables
+
+# per token losses, reduced by masked_loss_and_accuracy
+loss_object = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True,
+                                                            reduction=tf.keras.losses.Reduction.NONE)
+
+
+def masked_loss_and_accuracy(real, pred, mask=None):
+    """loss and accuracy averaged over the target tokens (padding excluded, packed rows
+    also mask the segment boundaries) and the nr of these tokens"""
+    if mask is None:
+        mask = tf.math.not_equal(real, 0)
+    mask = tf.cast(mask, tf.float32)
+    tokens = tf.reduce_sum(mask)
+
+    loss = tf.reduce_sum(loss_object(real, pred) * mask) / tokens
+    correct = tf.cast(tf.equal(tf.math.argmax(pred, axis=-1), real), tf.float32)
+    accuracy = tf.reduce_sum(correct * mask) / tokens
+    return loss, accuracy, tokens
+
+def get_step_inputs(data, segs, pack=False):
+    """splits a batch in model inputs, for packed rows the masks and positions
+    follow the segments of each example"""
+    inp, tar = data[:, 0], data[:, 1]
+    tar_inp = tar[:, :-1]
+    tar_real = tar[:, 1:]
+    if pack:
+        inp_segs, tar_segs = segs[:, 0], segs[:, 1]
+        enc_padding_mask, combined_mask, dec_padding_mask = create_packed_masks(inp_segs, tar_segs[:, :-1])
+        positions = segment_positions(inp_segs), segment_positions(tar_segs[:, :-1])
+        loss_mask = create_packed_loss_mask(tar_segs)
+    else:
+        enc_padding_mask, combined_mask, dec_padding_mask = create_masks(inp, tar_inp)
+        positions = None, None
+        loss_mask = None
+    return inp, tar_inp, tar_real, (enc_padding_mask, combined_mask, dec_padding_mask), positions, loss_mask
+
+def build_model(transformer, bert=False):
+    """creates the variables of the model with a forward pass on a dummy example"""
+    inp = tf.ones((1, 2), dtype=tf.int64)
+    tar = tf.ones((1, 2), dtype=tf.int64)
+    enc_padding_mask, combined_mask, dec_padding_mask = create_masks(inp, tar)
+    if bert:
+        # without a bert encoder (cached outputs) a dummy encoder output
+        enc_output = tf.zeros((1, 2, transformer.decoder.d_model)) if transformer.encoder is None else None
+        transformer(inp, tf.zeros_like(inp), tar, False, enc_padding_mask, combined_mask, dec_padding_mask,
+                    enc_output=enc_output)
+    else:
+        transformer(inp, tar, False, enc_padding_mask, combined_mask, dec_padding_mask)
+
+def forward(transformer, data, inp_segs, training, bert=False, pack=False, enc_output=None):
+    """predictions of a batch, with the expected ids and the loss mask"""
+    inp, tar_inp, tar_real, masks, positions, loss_mask = get_step_inputs(data, inp_segs, pack)
+    enc_padding_mask, combined_mask, dec_padding_mask = masks
+    inp_positions, tar_positions = positions
+    if bert:
+        predictions, _ = transformer(inp, inp_segs, tar_inp, training, enc_padding_mask, combined_mask,
+                                     dec_padding_mask, enc_output=enc_output)
+    else:
+        predictions, _ = transformer(inp, tar_inp, training, enc_padding_mask, combined_mask,
+                                     dec_padding_mask, inp_positions=inp_positions, tar_positions=tar_positions)
+    return predictions, tar_real, loss_mask
+
+def get_train_step_fn(transformer, optimizer, metrics=None, bert=False, pack=False, distributed=False):
+    """train step (data, segs[, enc_output]) -> loss, accuracy. metrics (StepMetrics) accumulate
+    them, distributed steps run in a replica context"""
+
+    def train_step_fn(data, inp_segs, enc_output=None):
+        with tf.GradientTape() as tape:
+            predictions, tar_real, loss_mask = forward(transformer, data, inp_segs, True, bert, pack, enc_output)
+            loss, acc, tokens = masked_loss_and_accuracy(tar_real, predictions, loss_mask)
+            # the gradients of the replicas are summed, the metrics keep the unscaled loss
+            scaled_loss = scale_to_global_tokens(loss, tokens) if distributed else loss
+
+        # tied embeddings appear once for each layer using them
+        variables = unique_variables(transformer.trainable_variables)
+        gradients = tape.gradient(scaled_loss, variables)
+        optimizer.apply_gradients(zip(gradients, variables))
+
+        if metrics is not None:
+            metrics.update(loss, acc, tokens)
+        return loss, acc
+    return train_step_fn
+
+def get_eval_step_fn(transformer, metrics=None, bert=False, pack=False):
+    """eval step (data, segs[, enc_output]) -> loss, accuracy"""
+
+    def eval_step_fn(data, inp_segs, enc_output=None):
+        predictions, tar_real, loss_mask = forward(transformer, data, inp_segs, False, bert, pack, enc_output)
+        loss, acc, tokens = masked_loss_and_accuracy(tar_real, predictions, loss_mask)
+        if metrics is not None:
+            metrics.update(loss, acc, tokens)
+        return loss, acc
+    return eval_step_fn
+
+def get_decode_step_fn(transformer, bert=False):
+    """decoding step (encoder_input, output) -> predictions, attention weights"""
+
+    def decode_step_fn(encoder_input, output):
+        enc_padding_mask, combined_mask, dec_padding_mask = create_masks(encoder_input, output)
+        if bert:
+            inp_seg = tf.zeros(shape=tf.shape(encoder_input), dtype=tf.dtypes.int64)
+            return transformer(encoder_input, inp_seg, output, False, enc_padding_mask,
+                               combined_mask, dec_padding_mask)
+        return transformer(encoder_input, output, False, enc_padding_mask,
+                           combined_mask, dec_padding_mask)
+    return decode_step_fn
+
+def init_beam(vocab_size, end_token_id, beam_width=1, normalize_beam=False):
+    length_penalty = 0.6 if normalize_beam else 0.0
+    config = beam_search.BeamSearchConfig(
+        beam_width=beam_width,
+        vocab_size=vocab_size,
+        eos_token=end_token_id,
+        length_penalty_weight=length_penalty,
+        choose_successors_fn=beam_search.choose_top_k)
+
+    beam_state = beam_search.BeamSearchState(
+        log_probs=tf.nn.log_softmax(tf.ones(config.beam_width)),
+        lengths=tf.constant(
+            1, shape=[config.beam_width], dtype=tf.int32),
+        finished=tf.zeros(
+            [config.beam_width], dtype=tf.bool))
+    return config, beam_state
+
+def beam_decode(decode_step, source_ids, start_token_id, end_token_id, vocab_size, beam_width, max_steps,
+                normalize_beam=False, pad_length=0, pad_input=True, stop_when_finished=True, profiler=None):
+    """beam search from the source ids (with start / end tokens), returns the output ids
+    (beam_width, length), the beam state and the attention weights of the last step.
+    with pad_length the input (if pad_input) and the output are padded to buckets of at
+    most pad_length, one compiled decode_step per bucket"""
+    profiler = profiler or Profiler()
+    encoder_input = tf.tile(tf.expand_dims(source_ids, 0), [beam_width, 1])
+    output = tf.expand_dims([start_token_id] * beam_width, 1)
+
+    config, beam_state = init_beam(vocab_size, end_token_id, beam_width, normalize_beam)
+    beam_values = tf.constant(start_token_id, shape=(1, beam_width))
+    beam_parents = tf.zeros((2, beam_width), dtype=tf.int32)
+    if pad_length and pad_input:
+        # padding is masked, one compilation per bucket of input lengths
+        encoder_input = pad_to_bucket(encoder_input, pad_length)
+
+    attention_weights = None
+    for i in range(max_steps):
+        with profiler.phase('decode_step'):
+            if pad_length:
+                # the look ahead mask hides the padding from the last real position
+                predictions, attention_weights = decode_step(encoder_input, pad_to_bucket(output, pad_length))
+                predictions = predictions[:, :output.shape[1], :]
+            else:
+                predictions, attention_weights = decode_step(encoder_input, output)
+            profiler.sync(predictions)
+        with profiler.phase('beam_search'):
+            # the prediction of the last position
+            beam_pred = tf.squeeze(predictions[:, -1:, :], 1)
+            bs_output, beam_state = beam_search.beam_search_step(time_=i, logits=beam_pred,
+                                                                 beam_state=beam_state, config=config)
+
+        # add new predictions to the beams decoder
+        with profiler.phase('gather_tree'):
+            beam_values = tf.concat([beam_values, tf.expand_dims(bs_output.predicted_ids, axis=0)], axis=0)
+            res = tf.cast(beam_search.gather_tree_py(beam_values.numpy(), beam_parents.numpy()), dtype=tf.int32)
+            output = tf.transpose(res)
+
+        beam_parents = tf.concat([beam_parents, tf.expand_dims(bs_output.beam_parent_ids, axis=0)], axis=0)
+
+        if stop_when_finished and tf.reduce_all(beam_state.finished):
+            break
+    return output, beam_state, attention_weights
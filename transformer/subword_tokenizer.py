@@ -0,0 +1,167 @@
+import collections
+import multiprocessing
+import os
+import random
+
+import tensorflow as tf
+import tensorflow_datasets as tfds
+from tensorflow_datasets.core.features.text import text_encoder
+from tensorflow_datasets.core.features.text.subword_text_encoder import _UNDERSCORE_REPLACEMENT,\
+    _trim_underscore_and_tell, _token_counts_from_generator
+
+# key marking the end of a subword in the trie, characters are never empty
+_END = ''
+# bytes of text counted by one task when building the vocabulary
+COUNT_CHUNK_BYTES = 2**25
+# distinct tokens kept while counting, the rarest ones are dropped above it
+MAX_TOKEN_COUNTS = 2**22
+
+
+class FastSubwordTextEncoder(tfds.features.text.SubwordTextEncoder):
+    """SubwordTextEncoder reading / writing the same .subwords files and giving the same ids.
+    the greedy longest match of a token walks a trie of the subwords instead of looking up
+    every prefix, decoding uses a precomputed id -> text table"""
+
+    def _init_from_list(self, subwords):
+        super(FastSubwordTextEncoder, self)._init_from_list(subwords)
+        self._trie = {}
+        for subword in list(self._subword_to_id) + [_UNDERSCORE_REPLACEMENT]:
+            node = self._trie
+            for char in subword:
+                node = node.setdefault(char, {})
+            node[_END] = True
+
+        # text subwords are stored trimmed, with their trailing space, bytes are kept as bytes
+        self._decode_table = []
+        for subword in self._subwords:
+            trimmed, add_space = _trim_underscore_and_tell(subword)
+            self._decode_table.append(trimmed + ' ' if add_space else trimmed)
+        self._decode_table.extend(bytes(bytearray([i])) for i in range(text_encoder.NUM_BYTES))
+
+    def _token_to_subwords(self, token):
+        subwords = []
+        start = 0
+        while start < len(token):
+            node, end = self._trie, None
+            for i in range(start, min(len(token), start + self._max_subword_len)):
+                node = node.get(token[i])
+                if node is None:
+                    break
+                if _END in node:
+                    end = i + 1
+            # no subword match found, consume a single (unicode) character
+            if end is None:
+                end = start + 1
+            subwords.append(token[start:end])
+            start = end
+        return subwords
+
+    def decode(self, ids):
+        ids = text_encoder.pad_decr(ids)
+        pieces, prev_bytes = [], []
+        for subword_id in ids:
+            if subword_id < 0 or subword_id >= len(self._decode_table):
+                raise ValueError('received id {} which is invalid, ids must be within [0, {})'.format(
+                    subword_id + 1, self.vocab_size))
+            piece = self._decode_table[subword_id]
+            if isinstance(piece, bytes):
+                prev_bytes.append(piece)
+                continue
+            if prev_bytes:
+                pieces.append(b''.join(prev_bytes).decode('utf-8', 'replace'))
+                prev_bytes = []
+            pieces.append(piece)
+        if prev_bytes:
+            pieces.append(b''.join(prev_bytes).decode('utf-8', 'replace'))
+        return ''.join(pieces)
+
+    def encode_batch(self, texts):
+        return [self.encode(text) for text in texts]
+
+    def decode_batch(self, ids_list):
+        return [self.decode(ids) for ids in ids_list]
+
+    @classmethod
+    def build_from_files(cls, files, target_vocab_size, workers=1, sample=1.0, seed=0,
+                         max_subword_length=20, reserved_tokens=None):
+        """same vocabulary as build_from_corpus over every line of the files, without
+        holding the corpus in memory. the token counts are computed in parallel over
+        byte ranges of the files and merged, a sample < 1 counts only that fraction of
+        the lines"""
+        reserved_tokens = reserved_tokens or []
+        tasks = [(path, start, end, sample, seed + i, reserved_tokens)
+                    for i, (path, start, end) in enumerate(get_byte_ranges(files, workers))]
+
+        token_counts = collections.Counter()
+        # spawned, forking a process running tensorflow is unsafe
+        with multiprocessing.get_context('spawn').Pool(workers) as pool:
+            for counts in pool.imap_unordered(count_tokens_range, tasks):
+                token_counts.update(counts)
+                prune_token_counts(token_counts)
+        tf.compat.v1.logging.info('subwords vocabulary: {} distinct tokens counted'.format(len(token_counts)))
+
+        # binary search on the minimum token count, as in build_from_corpus
+        def binary_search(min_token_count, max_token_count):
+            candidate_min = (min_token_count + max_token_count) // 2
+            tf.compat.v1.logging.info('subwords vocabulary: trying min_token_count {}'.format(candidate_min))
+            encoder = cls._build_from_token_counts(token_counts=token_counts, min_token_count=candidate_min,
+                                                   reserved_tokens=reserved_tokens, num_iterations=4,
+                                                   max_subword_length=max_subword_length)
+            vocab_size = encoder.vocab_size
+            # being within 1% of the target vocab size is ok
+            target_achieved = abs(vocab_size - target_vocab_size) * 100 < target_vocab_size
+            if target_achieved or min_token_count >= max_token_count or candidate_min <= 1:
+                return encoder
+
+            if vocab_size > target_vocab_size:
+                next_encoder = binary_search(candidate_min + 1, max_token_count)
+            else:
+                next_encoder = binary_search(min_token_count, candidate_min - 1)
+
+            if abs(vocab_size - target_vocab_size) < abs(next_encoder.vocab_size - target_vocab_size):
+                return encoder
+            return next_encoder
+
+        return binary_search(max(min(token_counts.values()), 1), max(token_counts.values()))
+
+def get_byte_ranges(files, workers):
+    """(path, start, end) ranges of at most COUNT_CHUNK_BYTES, at least 4 per worker"""
+    total_size = sum(os.path.getsize(path) for path in files)
+    chunk_size = max(1, min(COUNT_CHUNK_BYTES, total_size // (4 * workers)))
+    ranges = []
+    for path in files:
+        size = os.path.getsize(path)
+        ranges.extend((path, start, min(start + chunk_size, size)) for start in range(0, size, chunk_size))
+    return ranges
+
+def iter_range_lines(path, start, end):
+    """lines that start in [start, end) of the file"""
+    with open(path, 'rb') as f:
+        if start > 0:
+            # skips the line started in the previous range
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            yield line.decode('utf-8', errors='replace').strip()
+
+def count_tokens_range(task):
+    path, start, end, sample, seed, reserved_tokens = task
+    lines = iter_range_lines(path, start, end)
+    if sample < 1.0:
+        rng = random.Random(seed)
+        lines = (line for line in lines if rng.random() < sample)
+    token_counts = collections.Counter(_token_counts_from_generator(
+        generator=lines, max_chars=None, reserved_tokens=reserved_tokens))
+    prune_token_counts(token_counts)
+    return token_counts
+
+def prune_token_counts(token_counts):
+    """drops the rarest tokens until at most MAX_TOKEN_COUNTS are left"""
+    min_count = 1
+    while len(token_counts) > MAX_TOKEN_COUNTS:
+        for token in [token for token, count in token_counts.items() if count <= min_count]:
+            del token_counts[token]
+        min_count += 1
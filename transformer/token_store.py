@@ -0,0 +1,184 @@
+import array
+import json
+import os
+from os.path import join
+
+import numpy as np
+import tensorflow as tf
+from transformer.serialization import get_length_stats
+
+TOKENS_FILE = 'tokens.bin'
+OFFSETS_FILE = 'offsets.npy'
+ROW_STARTS_FILE = 'row_starts_{}.npy'
+META_FILE = 'meta.json'
+# rows gathered by one call of the numpy reader
+READ_BLOCK = 256
+# blocks read at the same time by a shuffled source
+SHUFFLE_CYCLE = 16
+
+
+def get_token_dtype(max_id: int):
+    return np.uint16 if max_id < 2**16 else np.uint32
+
+def write_token_store(path: str, examples, max_id: int, info: dict, counts=None, pack_seq_length=0):
+    """writes the unpadded (source ids, target ids) examples in a flat token array.
+    offsets[2 * i] is the start of the source of example i, offsets[2 * i + 1] the start
+    of its target and offsets[2 * i + 2] the end of its target. info is stored in the
+    meta file with the length stats, it describes how the store was built. counts
+    (filled while the examples are read, e.g. skipped pairs) are stored too. with
+    pack_seq_length the packed rows of that length are computed as well"""
+    if not os.path.exists(path):
+        os.makedirs(path)
+    dtype = get_token_dtype(max_id)
+    offsets = array.array('q', [0])
+
+    with open(join(path, TOKENS_FILE), 'wb') as f:
+        for source, target in examples:
+            for ids in (source, target):
+                f.write(np.asarray(ids, dtype=dtype).tobytes())
+                offsets.append(offsets[-1] + len(ids))
+
+    offsets = np.frombuffer(offsets, dtype=np.int64)
+    np.save(join(path, OFFSETS_FILE), offsets)
+    lengths = np.diff(offsets)
+    meta = dict(info, dtype=np.dtype(dtype).name, examples=len(lengths) // 2, tokens=int(offsets[-1]),
+                stats=get_length_stats(lengths[0::2], lengths[1::2]), **dict(counts or {}))
+    write_token_store_meta(path, meta)
+    tf.compat.v1.logging.info('token store written in {}, {} examples {} tokens'.format(
+        path, meta['examples'], meta['tokens']))
+    if pack_seq_length:
+        write_row_starts(path, offsets, pack_seq_length, meta)
+    return meta
+
+def write_token_store_meta(path: str, meta: dict):
+    with open(join(path, META_FILE), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+def read_token_store_meta(path: str):
+    """meta of the store, None if there is no store in path"""
+    meta_path = join(path, META_FILE)
+    if not os.path.isfile(meta_path):
+        return None
+    with open(meta_path, 'r') as f:
+        return json.load(f)
+
+def pack_rows(source_lengths, target_lengths, seq_length):
+    """first example of each packed row, same greedy packing as dataset.pack_gec_examples,
+    the last value is the nr of examples"""
+    row_starts = array.array('q', [0])
+    source_total, target_total = 0, 0
+    for i, (source_length, target_length) in enumerate(zip(source_lengths, target_lengths)):
+        if source_total and (source_total + source_length > seq_length or
+                             target_total + target_length > seq_length):
+            row_starts.append(i)
+            source_total, target_total = 0, 0
+        source_total += source_length
+        target_total += target_length
+    row_starts.append(len(source_lengths))
+    return np.frombuffer(row_starts, dtype=np.int64)
+
+def write_row_starts(path: str, offsets, seq_length: int, meta: dict):
+    """saves the pack_rows of seq_length next to the offsets, their nr is kept in
+    meta['packed_rows'] by seq_length. returns the row starts"""
+    lengths = np.minimum(np.diff(offsets), seq_length)
+    row_starts = pack_rows(lengths[0::2], lengths[1::2], seq_length)
+    np.save(join(path, ROW_STARTS_FILE.format(seq_length)), row_starts)
+    meta.setdefault('packed_rows', {})[str(seq_length)] = len(row_starts) - 1
+    write_token_store_meta(path, meta)
+    tf.compat.v1.logging.info('packed rows of {} tokens written in {}, {} rows'.format(
+        seq_length, path, len(row_starts) - 1))
+    return row_starts
+
+class TokenStore(object):
+    """memory mapped view of a store written by write_token_store, rows are read
+    padded to seq_length in the same format as dataset.pad_gec / pack_gec_examples"""
+
+    def __init__(self, path: str, seq_length: int, pack: bool = False):
+        self.meta = read_token_store_meta(path)
+        self.seq_length = seq_length
+        self.pack = pack
+        if self.meta['tokens'] > 0:
+            self.tokens = np.memmap(join(path, TOKENS_FILE), dtype=self.meta['dtype'], mode='r')
+        else:
+            # an empty file can not be mapped
+            self.tokens = np.zeros((0, ), dtype=self.meta['dtype'])
+        self.offsets = np.load(join(path, OFFSETS_FILE), mmap_mode='r')
+
+        if pack:
+            # computed when the store is written, or once for a new seq_length
+            row_starts_path = join(path, ROW_STARTS_FILE.format(seq_length))
+            if str(seq_length) in self.meta.get('packed_rows', {}) and os.path.isfile(row_starts_path):
+                self.row_starts = np.load(row_starts_path, mmap_mode='r')
+            else:
+                self.row_starts = write_row_starts(path, self.offsets, seq_length, self.meta)
+            self.nr_rows = len(self.row_starts) - 1
+        else:
+            self.row_starts = None
+            self.nr_rows = self.meta['examples']
+
+    def __len__(self):
+        return self.nr_rows
+
+    def get_rows(self, rows):
+        """padded ids (len(rows), 2, seq_length) and segments of the rows"""
+        if not self.pack:
+            return self.get_example_rows(rows)
+        seq_length = self.seq_length
+        data = np.zeros((len(rows), 2, seq_length), dtype=np.int64)
+        segs = np.zeros((len(rows), 2, seq_length), dtype=np.int64)
+
+        for b, row in enumerate(rows):
+            positions = [0, 0]
+            for segment_id, example in enumerate(range(self.row_starts[row], self.row_starts[row + 1]), 1):
+                for side in (0, 1):
+                    start = self.offsets[2 * example + side]
+                    end = min(self.offsets[2 * example + side + 1], start + seq_length - positions[side])
+                    position, length = positions[side], end - start
+                    data[b, side, position:position + length] = self.tokens[start:end]
+                    segs[b, side, position:position + length] = segment_id
+                    positions[side] += length
+        return data, segs
+
+    def get_example_rows(self, rows):
+        """rows of one example each, gathered for all the rows at once: the token index of
+        each (row, side, position) is computed from the offsets, the padding is masked"""
+        rows = np.asarray(rows, dtype=np.int64)
+        positions = np.arange(self.seq_length)
+        # (rows, side) starts and lengths cut to seq_length
+        starts = self.offsets[2 * rows[:, None] + np.arange(2)]
+        lengths = np.minimum(self.offsets[2 * rows[:, None] + np.arange(1, 3)] - starts, self.seq_length)
+        mask = positions < lengths[:, :, None]
+        data = np.zeros((len(rows), 2, self.seq_length), dtype=np.int64)
+        data[mask] = np.take(self.tokens, (starts[:, :, None] + positions)[mask])
+        # same segments as dataset.pad_gec
+        segs = (positions >= lengths[:, 0, None]).astype(np.int64)
+        return data, segs
+
+    def get_dataset(self, start=0, end=None, shuffle=False, seed=None, features=None):
+        """tf.data source over the rows [start, end), read from the mapped files in blocks of
+        READ_BLOCK consecutive rows. a shuffled source visits the blocks in a new order each
+        epoch and reads SHUFFLE_CYCLE of them at a time, consecutive rows come from different
+        blocks. only the block starts are held in memory. features (encoder_cache.EncoderCache)
+        adds the cached encoder outputs of the rows to each element"""
+        end = len(self) if end is None else end
+        segs_shape = [2, self.seq_length] if self.pack else [self.seq_length]
+
+        def read_block(block_start):
+            rows = tf.range(block_start, tf.minimum(block_start + READ_BLOCK, end))
+            data, segs = tf.numpy_function(self.get_rows, [rows], (tf.int64, tf.int64))
+            data.set_shape([None, 2, self.seq_length])
+            segs.set_shape([None] + segs_shape)
+            if features is None:
+                return data, segs
+            enc_output = tf.numpy_function(features.get_rows, [rows], features.dtype)
+            enc_output.set_shape([None, self.seq_length, features.d_model])
+            return data, segs, enc_output
+
+        blocks = tf.data.Dataset.range(start, end, READ_BLOCK)
+        if not shuffle:
+            dataset = blocks.map(read_block, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+            return dataset.unbatch()
+        nr_blocks = max(1, (end - start + READ_BLOCK - 1) // READ_BLOCK)
+        blocks = blocks.shuffle(nr_blocks, seed=seed, reshuffle_each_iteration=True)
+        return blocks.interleave(lambda block_start: tf.data.Dataset.from_tensor_slices(read_block(block_start)),
+                                 cycle_length=SHUFFLE_CYCLE, num_parallel_calls=tf.data.experimental.AUTOTUNE)
@@ -4,22 +4,39 @@ from transformer.decoder import Decoder
 
 class Transformer(tf.keras.Model):
     def __init__(self, num_layers, d_model, num_heads, dff, input_vocab_size, 
-                target_vocab_size, pe_input, pe_target, rate=0.1):
+                target_vocab_size, pe_input, pe_target, rate=0.1, recompute=False,
+                tie_embeddings=False):
         super(Transformer, self).__init__()
+        embedding = None
+        if tie_embeddings:
+            # source and target share the subword vocabulary
+            assert input_vocab_size == target_vocab_size
+            embedding = tf.keras.layers.Embedding(target_vocab_size, d_model)
+
         self.encoder = Encoder(num_layers, d_model, num_heads, dff, 
-                            input_vocab_size, pe_input, rate)
+                            input_vocab_size, pe_input, rate, recompute=recompute,
+                            embedding=embedding)
         self.decoder = Decoder(num_layers, d_model, num_heads, dff, 
-                            target_vocab_size, pe_target, rate)
-        self.final_layer = tf.keras.layers.Dense(target_vocab_size)
+                            target_vocab_size, pe_target, rate, recompute=recompute,
+                            embedding=embedding)
+        if tie_embeddings:
+            # the output projection is the transposed embedding matrix
+            self.final_layer = None
+        else:
+            self.final_layer = tf.keras.layers.Dense(target_vocab_size)
         
     def call(self, inp, tar, training, enc_padding_mask, 
-            look_ahead_mask, dec_padding_mask):
-        enc_output = self.encoder(inp, training, enc_padding_mask)  # (batch_size, inp_seq_len, d_model)
+            look_ahead_mask, dec_padding_mask, inp_positions=None, tar_positions=None):
+        enc_output = self.encoder(inp, training, enc_padding_mask,
+                            positions=inp_positions)  # (batch_size, inp_seq_len, d_model)
         # dec_output.shape == (batch_size, tar_seq_len, d_model)
 
         dec_output, attention_weights = self.decoder(
-            tar, enc_output, training, look_ahead_mask, dec_padding_mask)
+            tar, enc_output, training, look_ahead_mask, dec_padding_mask, positions=tar_positions)
         
-        final_output = self.final_layer(dec_output)  # (batch_size, tar_seq_len, target_vocab_size)
+        if self.final_layer is None:
+            final_output = tf.matmul(dec_output, self.decoder.embedding.embeddings, transpose_b=True)
+        else:
+            final_output = self.final_layer(dec_output)  # (batch_size, tar_seq_len, target_vocab_size)
         
         return final_output, attention_weights
\ No newline at end of file
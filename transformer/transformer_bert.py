@@ -7,27 +7,44 @@ class TransformerBert(tf.keras.Model):
     def __init__(self, num_layers=None, d_model=None, num_heads=None, dff=None,
                 input_vocab_size=None, 
                 target_vocab_size=None, model_dir=None, pe_input=None, pe_target=None, rate=0.1, 
-                decoder=None, final_layer=None, args=None):
+                decoder=None, final_layer=None, args=None, recompute=False, tie_embeddings=False,
+                cached_encoder=False):
         super(TransformerBert, self).__init__()
 
-        self.encoder = BertEncoder(model_dir=model_dir, d_model=d_model, args=args)
+        if cached_encoder:
+            # the encoder outputs are always given (enc_output), bert is neither built nor loaded
+            self.encoder = None
+        else:
+            self.encoder = BertEncoder(model_dir=model_dir, d_model=d_model, args=args)
         if decoder:
             self.decoder = decoder
         else:
             self.decoder = Decoder(num_layers, d_model, num_heads, dff, 
-                            target_vocab_size, pe_target, rate)
+                            target_vocab_size, pe_target, rate, recompute=recompute)
         if final_layer:
             self.final_layer = final_layer
+        elif tie_embeddings:
+            # the output projection is the transposed decoder embedding matrix
+            self.final_layer = None
         else:
             self.final_layer = tf.keras.layers.Dense(target_vocab_size)
         
     def call(self, input_ids, input_seg, tar, training, enc_padding_mask, 
-            look_ahead_mask, dec_padding_mask):
-        enc_output = self.encoder(input_ids, input_seg, training)  # (batch_size, inp_seq_len, d_model)
+            look_ahead_mask, dec_padding_mask, enc_output=None):
+        if enc_output is None:
+            if self.encoder is None:
+                raise ValueError('the model has no bert encoder (cached_encoder), enc_output is required')
+            enc_output = self.encoder(input_ids, input_seg, training)  # (batch_size, inp_seq_len, d_model)
+        else:
+            # precomputed by the frozen encoder, possibly stored as float16
+            enc_output = tf.cast(enc_output, tf.float32)
         # dec_output.shape == (batch_size, tar_seq_len, d_model)
         dec_output, attention_weights = self.decoder(
             tar, enc_output, training, look_ahead_mask, dec_padding_mask)
         
-        final_output = self.final_layer(dec_output)  # (batch_size, tar_seq_len, target_vocab_size)
+        if self.final_layer is None:
+            final_output = tf.matmul(dec_output, self.decoder.embedding.embeddings, transpose_b=True)
+        else:
+            final_output = self.final_layer(dec_output)  # (batch_size, tar_seq_len, target_vocab_size)
         
         return final_output, attention_weights
\ No newline at end of file
@@ -1,3 +1,5 @@
+import functools
+
 import tensorflow as tf
 import numpy as np
 
@@ -5,7 +7,10 @@ def get_angles(pos, i, d_model):
     angle_rates = 1 / np.power(10000, (2 * (i//2)) / np.float32(d_model))
     return pos * angle_rates
 
+@functools.lru_cache(maxsize=None)
 def positional_encoding(position, d_model):
+    """cached, encoder and decoder with the same sizes share one table. called from
+    the layers build, which runs eagerly, so the table can be captured by any graph"""
     angle_rads = get_angles(np.arange(position)[:, np.newaxis],
                             np.arange(d_model)[np.newaxis, :],
                             d_model)
@@ -43,6 +48,51 @@ def point_wise_feed_forward_network(d_model, dff):
         tf.keras.layers.Dense(d_model)  # (batch_size, seq_len, d_model)
     ])
 
+def stateless_dropout(x, rate, seed):
+    """dropout whose mask only depends on seed (int64 tensor of shape [2])"""
+    keep = tf.random.stateless_uniform(tf.shape(x), seed=seed, dtype=x.dtype) >= rate
+    return tf.where(keep, x / (1.0 - rate), tf.zeros_like(x))
+
+def offset_seed(seed, offset):
+    """distinct seed for each dropout of a layer, None stays None"""
+    return None if seed is None else seed + tf.constant([0, offset], dtype=seed.dtype)
+
+class SeededDropout(tf.keras.layers.Dropout):
+    """keras dropout, stateless when called with a seed: the same seed gives the same mask"""
+
+    def call(self, inputs, training=None, seed=None):
+        if seed is None or self.rate == 0:
+            return super(SeededDropout, self).call(inputs, training=training)
+        # as keras dropout, the inputs are returned unchanged when not training
+        return tf.keras.backend.in_train_phase(lambda: stateless_dropout(inputs, self.rate, seed), inputs,
+                                               training=training)
+
+def recompute_layer(layer, tensors, *args):
+    """calls layer(*tensors, *args, seed=seed) keeping only the tensors for the backward pass,
+    the activations inside the layer are recomputed when the gradients are computed.
+    gradients flow to the tensors and the layer variables (not to args), the variables
+    must already exist. for layers returning a tuple only the first output is kept.
+    the seed is drawn once per call, outside the recomputed function, so the dropouts
+    of the recomputation (SeededDropout) draw the masks of the forward pass"""
+    seed = tf.random.uniform([2], maxval=2**31 - 1, dtype=tf.int64)
+
+    def forward(*tensors):
+        output = layer(*tensors, *args, seed=seed)
+        return output[0] if isinstance(output, tuple) else output
+    return tf.recompute_grad(forward)(*tensors)
+
+def get_epoch_seed(shuffle_seed, epoch):
+    """seed of the train data order of an epoch, the order of epoch e does not depend on the
+    epochs iterated before in the process: a restarted job rebuilds it. None without a seed"""
+    return None if shuffle_seed is None else shuffle_seed + epoch
+
+def unique_variables(variables):
+    """removes the duplicates of shared variables (tied embeddings), keeps the order"""
+    unique = {}
+    for variable in variables:
+        unique.setdefault(id(variable), variable)
+    return list(unique.values())
+
 def create_masks(inp, tar):
     # Encoder padding mask
     enc_padding_mask = create_padding_mask(inp)
@@ -62,3 +112,36 @@ def create_masks(inp, tar):
 
 
 
+
+
+def create_segment_mask(q_segs, k_segs):
+    """masks keys from other packed examples than the query and padding keys (segment 0)"""
+    same_segment = tf.equal(q_segs[:, :, tf.newaxis], k_segs[:, tf.newaxis, :])
+    not_padding = tf.not_equal(k_segs, 0)[:, tf.newaxis, :]
+    mask = 1 - tf.cast(tf.logical_and(same_segment, not_padding), tf.float32)
+    return mask[:, tf.newaxis, :, :]  # (batch_size, 1, seq_len_q, seq_len_k)
+
+def create_packed_masks(inp_segs, tar_segs):
+    """block diagonal masks for rows with several packed examples, tar_segs are the
+    segments of the decoder input"""
+    enc_padding_mask = create_segment_mask(inp_segs, inp_segs)
+    # decoder tokens attend only the encoder outputs of their own example
+    dec_padding_mask = create_segment_mask(tar_segs, inp_segs)
+
+    look_ahead_mask = create_look_ahead_mask(tf.shape(tar_segs)[1])
+    combined_mask = tf.maximum(create_segment_mask(tar_segs, tar_segs), look_ahead_mask)
+
+    return enc_padding_mask, combined_mask, dec_padding_mask
+
+def segment_positions(segs):
+    """position of each token inside its packed example, restarts from 0 for each segment"""
+    seq_len = tf.shape(segs)[1]
+    same_segment = tf.cast(tf.equal(segs[:, :, tf.newaxis], segs[:, tf.newaxis, :]), tf.int32)
+    previous = tf.cast(tf.linalg.band_part(tf.ones((seq_len, seq_len)), -1, 0), tf.int32)
+    return tf.reduce_sum(same_segment * previous, axis=-1) - 1  # (batch_size, seq_len)
+
+def create_packed_loss_mask(tar_segs):
+    """tokens of tar[:, 1:] that are predicted inside their own example, the start token
+    of the next packed example and the padding are excluded"""
+    same_segment = tf.equal(tar_segs[:, 1:], tar_segs[:, :-1])
+    return tf.logical_and(same_segment, tf.not_equal(tar_segs[:, 1:], 0))